@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+datahref_bench
+--------------
+
+Microbenchmark of DataHref on large rich-text messages, against the
+previous implementation (two uncompiled re.sub passes in plaintext(), and
+re-encoding in href() on every call):
+
+    python benchmarks/datahref_bench.py --size 64
+"""
+
+import os
+import re
+import sys
+import base64
+import timeit
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lyncbot.ucwa import DataHref
+
+try:
+    from urllib.parse import quote_plus
+except ImportError:
+    from urllib import quote_plus
+
+
+def old_plaintext(text):
+    return re.sub(r'\s+', ' ', re.sub('<[^>]*>', ' ', text)).strip()
+
+
+def old_href(text, content_type='text/html', encoding='charset=utf-8'):
+    return "data:%s;%s,%s" % (content_type, encoding, quote_plus(text))
+
+
+def message(kib):
+    row = ('<tr><td style="color: #333">Build &amp; deploy</td>'
+           '<td><b>passed</b> in 12s &mdash; see '
+           '<a href="http://ci.example.com/job/42">job 42</a></td></tr>\n')
+    body = row * (kib * 1024 // len(row) + 1)
+    return '<html><body><table>%s</table></body></html>' % body
+
+
+def bench(name, stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print("%-30s %8.1f us" % (name, best / number * 1e6))
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--size', type=int, default=64,
+                        help="message size in KiB")
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    text = message(args.size)
+    quoted = 'data:text/html;charset=utf-8,' + quote_plus(text)
+    b64 = 'data:text/html;charset=utf-8;base64,' + \
+        base64.b64encode(text.encode('utf-8')).decode('ascii')
+    d = DataHref(quoted)
+    print("%d KiB of HTML" % (len(text) // 1024))
+
+    old = bench('plaintext (old)', lambda: old_plaintext(text), args.number)
+    new = bench('plaintext', d.plaintext, args.number)
+    print("%-30s %8.1fx" % ('', old / new))
+    # most messages have no entities to unescape
+    plain = text.replace('&amp;', 'and').replace('&mdash;', '-')
+    d_plain = DataHref.from_str(plain, 'text/html')
+    old = bench('plaintext, no entities (old)',
+                lambda: old_plaintext(plain), args.number)
+    new = bench('plaintext, no entities', d_plain.plaintext, args.number)
+    print("%-30s %8.1fx" % ('', old / new))
+    old = bench('href (old)', lambda: old_href(d), args.number)
+    new = bench('href', d.href, args.number)
+    print("%-30s %8.1fx" % ('', old / new))
+    bench('decode quoted', lambda: DataHref(quoted), args.number)
+    bench('decode base64', lambda: DataHref(b64), args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+"""
+ucwa_bench
+----------
+
+End-to-end benchmark of lyncbot against the mock UCWA server from
+tests/mock_ucwa.py:
+
+    python benchmarks/ucwa_bench.py --users 50 --latency 0.02
+
+Logs N users in, listens to all of their event channels on one
+EventMultiplexer like the plugin does, and reports login time, outbound
+messages per second, inbound event-to-callback latency percentiles and
+memory per session.  With errbot installed, --plugin drives the same
+traffic through the Lyncbot plugin on errbot's test backend instead.
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lyncbot import ucwa, transport, aio
+from tests.mock_ucwa import MockUCWAServer
+
+PEER = 'peer@example.com'
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    result = {}
+    for p in points:
+        i = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        result['p%d' % p] = samples[i]
+    result['max'] = samples[-1]
+    return result
+
+
+def report(name, samples, unit='ms', scale=1000.0):
+    stats = percentiles(samples)
+    print("%-22s %s" % (name, "  ".join(
+        "%s=%.1f%s" % (k, v * scale, unit) for k, v in stats.items())))
+
+
+def run_threads(target, items, concurrency):
+    """Calls target(item) for every item from `concurrency` threads."""
+    items = list(items)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not items:
+                    return
+                item = items.pop()
+            target(item)
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class Session:
+    def __init__(self, email):
+        self.email = email
+        self.u = None
+        self.chat = None
+        self.latencies = []
+        self.delivered = 0
+
+
+def login(sessions, pool, http, concurrency):
+    times = []
+
+    def _login(s):
+        t = time.time()
+        s.u = ucwa.LyncUCWA(s.email, 'secret', transport=pool,
+                            async_transport=http)
+        times.append(time.time() - t)
+    run_threads(_login, sessions, concurrency)
+    return times
+
+
+def bench_library(server, args):
+    users = ['user%d@example.com' % i for i in range(args.users)]
+    for email in users:
+        server.add_user(email)
+        server.add_contact(email, PEER)
+    pool = transport.HTTPPool(maxsize=args.concurrency)
+    mux = aio.EventMultiplexer().start()
+    sessions = [Session(email) for email in users]
+
+    t = time.time()
+    times = login(sessions, pool, mux.http, args.concurrency)
+    print("%-22s %d sessions in %.2fs" % ('login', len(sessions),
+                                          time.time() - t))
+    report('login time', times)
+    for s in sessions:
+        mux.add(s.u)
+
+    # outbound: every session sends to the peer through its outbox
+    total = args.users * args.messages
+    lock = threading.Lock()
+    errors = []
+
+    def delivered(s):
+        def callback(text, error):
+            with lock:
+                s.delivered += 1
+                if error is not None:
+                    errors.append(error)
+        return callback
+    t = time.time()
+    for s in sessions:
+        s.chat = s.u.new_conversation([PEER])
+        for i in range(args.messages):
+            s.chat.queue_message('message %d' % i, delivered(s))
+    wait_for(lambda: sum(s.delivered for s in sessions) >= total,
+             args.timeout)
+    elapsed = time.time() - t
+    print("%-22s %d in %.2fs = %.1f msg/s (%d failed)" % (
+        'outbound messages', total, elapsed, total / elapsed, len(errors)))
+
+    # inbound: the peer writes back, stamping each message with its send
+    # time, and the session's callback measures how long delivery took
+    def inbound(s):
+        def callback(message):
+            stamp = float(message.split(': ', 1)[1])
+            s.latencies.append(time.time() - stamp)
+        return callback
+    for s in sessions:
+        s.chat.set_inbound_callback(inbound(s))
+    for i in range(args.events):
+        for s in sessions:
+            server.send_message(PEER, s.email, repr(time.time()))
+        time.sleep(args.event_interval)
+    expected = args.users * args.events
+    wait_for(lambda: sum(len(s.latencies) for s in sessions) >= expected,
+             args.timeout)
+    latencies = [l for s in sessions for l in s.latencies]
+    print("%-22s %d of %d received" % ('inbound events', len(latencies),
+                                       expected))
+    report('event->callback', latencies)
+
+    mux.stop()
+    pool.clear()
+
+
+def bench_memory(server, args):
+    """Memory held per idle, listening session, measured with tracemalloc
+    on its own so it doesn't skew the timings above."""
+    users = ['mem%d@example.com' % i for i in range(args.memory_sessions)]
+    for email in users:
+        server.add_user(email)
+        server.add_contact(email, PEER)
+    pool = transport.HTTPPool(maxsize=args.concurrency)
+    mux = aio.EventMultiplexer().start()
+    sessions = [Session(email) for email in users]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    login(sessions, pool, mux.http, args.concurrency)
+    for s in sessions:
+        mux.add(s.u)
+        s.u.contacts()
+    time.sleep(0.5)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print("%-22s %.1f KiB over %d sessions" % (
+        'memory per session', used / 1024.0 / len(sessions), len(sessions)))
+    mux.stop()
+    pool.clear()
+
+
+def bench_plugin(server, args):
+    """Runs one user's traffic through the Lyncbot plugin on errbot's
+    test backend."""
+    from errbot.backends.test import TestBot
+    email = 'plugin@example.com'
+    server.add_user(email)
+    server.add_contact(email, PEER)
+    bot = TestBot(extra_plugin_dir=ROOT, loglevel=logging.ERROR)
+    bot.start()
+    try:
+        plugin = bot.bot.plugin_manager.get_plugin_obj_by_name('Lyncbot')
+        chatname = str(bot.bot.sender)
+
+        t = time.time()
+        if not plugin.lync_login(chatname, email, 'secret'):
+            raise Exception("plugin login failed")
+        print("%-22s %.1fms" % ('plugin login', (time.time() - t) * 1000))
+
+        bot.push_message('!chat with %s' % PEER)
+        bot.pop_message()
+        app = server.app_for(email)
+        t = time.time()
+        for i in range(args.messages):
+            bot.push_message('message %d' % i)
+        wait_for(lambda: sum(len(c['messages']) for c in
+                             app.conversations.values()) >= args.messages,
+                 args.timeout)
+        elapsed = time.time() - t
+        print("%-22s %d in %.2fs = %.1f msg/s" % (
+            'plugin messages', args.messages, elapsed,
+            args.messages / elapsed))
+
+        latencies = []
+        for i in range(args.events):
+            server.send_message(PEER, email, repr(time.time()))
+            reply = bot.pop_message(timeout=args.timeout)
+            latencies.append(time.time() - float(reply.split(': ', 1)[1]))
+        report('plugin event->reply', latencies)
+    finally:
+        bot.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=10,
+                        help="outbound messages per user")
+    parser.add_argument('--events', type=int, default=10,
+                        help="inbound messages per user")
+    parser.add_argument('--event-interval', type=float, default=0.01)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds the mock server adds to each request")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--memory-sessions', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--plugin', action='store_true',
+                        help="drive the errbot plugin instead")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    server = MockUCWAServer(latency=args.latency).start()
+    server.add_user(PEER, 'Peer')
+    discover_url = ucwa.LyncUCWA.DISCOVER_URL
+    ucwa.LyncUCWA.DISCOVER_URL = server.discover_url
+    try:
+        if args.plugin:
+            bench_plugin(server, args)
+        else:
+            bench_library(server, args)
+            bench_memory(server, args)
+        print("%-22s %d" % ('server requests', len(server.requests)))
+    finally:
+        ucwa.LyncUCWA.DISCOVER_URL = discover_url
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
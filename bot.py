@@ -1,8 +1,11 @@
-import threading
+import inspect
+import functools
+import contextlib
 
 from errbot import BotPlugin, botcmd, arg_botcmd, webhook
 
-from lyncbot import web, ucwa
+from lyncbot import web, ucwa, transport, aio, session, metrics, trace, \
+    sharding, recorder
 
 
 def check_logged_in(func):
@@ -13,8 +16,55 @@ def check_logged_in(func):
 Please log in at http://127.0.0.1:3141/lyncbot"""
         return func(self, message, args)
     return wrap
+
+
+def traced(func):
+    """Records the Lync HTTP calls a command makes under a span named
+    after it, when tracing is on."""
+    @functools.wraps(func)
+    def wrap(self, message, *args):
+        span = self.trace_span(func.__name__, frm=str(message.frm))
+        if inspect.isgeneratorfunction(func):
+            def run():
+                with span:
+                    return (yield from func(self, message, *args))
+            return run()
+        with span:
+            return func(self, message, *args)
+    return wrap
         
 
+CONFIG_TEMPLATE = {
+    # idle keep-alive connections kept per Lync pool host
+    'POOL_SIZE': 10,
+    # seconds before an idle connection is dropped instead of reused
+    'POOL_IDLE_TIMEOUT': 60,
+    # resources cached per user, and for how many seconds
+    'CACHE_SIZE': 1024,
+    'CACHE_TTL': 60,
+    # encrypted file keeping Lync sessions across restarts, and its key
+    # (see lyncbot.session.SessionStore.generate_key); None disables it
+    'SESSION_STORE': None,
+    'SESSION_KEY': None,
+    # requests per second allowed for each user, and for all users
+    # together on each Lync server; None means unlimited
+    'USER_RATE_LIMIT': 5,
+    'SERVER_RATE_LIMIT': None,
+    # record the Lync HTTP calls made by each command, message and event,
+    # appending them as JSON lines to TRACE_FILE if set; with SHARDS each
+    # worker traces to this name plus its shard number
+    'TRACING': False,
+    'TRACE_FILE': None,
+    # gzipped JSON lines file to record the Lync event pages and resources
+    # each session reads to, for replay with lyncbot.recorder; with SHARDS
+    # each worker records to this name plus its shard number
+    'RECORD_FILE': None,
+    # worker processes owning the Lync sessions, users being spread over
+    # them by hashing; 0 keeps every session in the bot process
+    'SHARDS': 0,
+}
+
+
 class Lyncbot(BotPlugin, web.WebInterface):
     """
     Lync (Skype for Business) integration
@@ -25,18 +75,68 @@ class Lyncbot(BotPlugin, web.WebInterface):
         self.conns = {}
         self.chats = {}
         self.current_chat = {}
+        # all users share one keep-alive pool to the Lync servers
+        self.transport = transport.HTTPPool(
+            maxsize=self.get_config('POOL_SIZE'),
+            idle_timeout=self.get_config('POOL_IDLE_TIMEOUT'))
+        # one asyncio loop listens to every user's event channel
+        self.mux = aio.EventMultiplexer(aio.AsyncHTTP(
+            maxsize=self.get_config('POOL_SIZE'),
+            idle_timeout=self.get_config('POOL_IDLE_TIMEOUT'))).start()
+        self.tracer = None
+        if self.get_config('TRACING') or self.get_config('TRACE_FILE'):
+            self.tracer = trace.Tracer(self.get_config('TRACE_FILE'))
+        self.recorder = None
+        if self.get_config('RECORD_FILE') and not self.get_config('SHARDS'):
+            self.recorder = recorder.Recorder(self.get_config('RECORD_FILE'))
+        self.host_limiter = None
+        if self.get_config('SERVER_RATE_LIMIT'):
+            self.host_limiter = transport.HostLimiter(
+                self.get_config('SERVER_RATE_LIMIT'))
+        self.session_store = None
+        if self.get_config('SESSION_STORE') and self.get_config('SESSION_KEY'):
+            self.session_store = session.SessionStore(
+                self.get_config('SESSION_STORE'),
+                self.get_config('SESSION_KEY'))
+        self.shards = None
+        shards = self.get_config('SHARDS')
+        if shards:
+            server_rate_limit = self.get_config('SERVER_RATE_LIMIT')
+            self.shards = sharding.ShardPool(shards, dict(
+                pool_size=self.get_config('POOL_SIZE'),
+                pool_idle_timeout=self.get_config('POOL_IDLE_TIMEOUT'),
+                cache_size=self.get_config('CACHE_SIZE'),
+                cache_ttl=self.get_config('CACHE_TTL'),
+                rate_limit=self.get_config('USER_RATE_LIMIT'),
+                # each shard gets its share of the server's limit
+                server_rate_limit=server_rate_limit and
+                float(server_rate_limit) / shards,
+                session_store=self.get_config('SESSION_STORE'),
+                session_key=self.get_config('SESSION_KEY'),
+                tracing=self.get_config('TRACING'),
+                trace_file=self.get_config('TRACE_FILE'),
+                record_file=self.get_config('RECORD_FILE')))
+        if self.session_store is not None:
+            self.resume_sessions()
         
     def deactivate(self):
+        if self.shards is not None:
+            self.shards.stop()
+        self.mux.stop()
+        self.transport.clear()
+        if self.recorder is not None:
+            self.recorder.close()
         super(Lyncbot, self).deactivate()
 
-    #def get_configuration_template(self):
-    #    return {'EXAMPLE_KEY_1': "Example value",
-    #            'EXAMPLE_KEY_2': ["Example", "Value"]
-    #           }
+    def get_configuration_template(self):
+        return CONFIG_TEMPLATE
 
     def check_configuration(self, configuration):
         super(Lyncbot, self).check_configuration(configuration)
 
+    def get_config(self, key):
+        return (self.config or {}).get(key, CONFIG_TEMPLATE[key])
+
     def callback_connect(self):
         pass
 
@@ -46,6 +146,12 @@ class Lyncbot(BotPlugin, web.WebInterface):
             return
         if message.body.startswith('!'):
             return
+        self.forward_message(message)
+
+    @traced
+    def forward_message(self, message):
+        """Sends a chat message on to the Lync conversation it is for."""
+        frm = str(message.frm)
         message_text = message.body
         if message.body.startswith('@'):
             dest, message_text = message.body.split(None, 1)
@@ -57,13 +163,68 @@ class Lyncbot(BotPlugin, web.WebInterface):
             self.send(message.frm, "Sorry - please open a chat first with "
                       "the !chat command.", in_reply_to=message)
             return
-        chat.send(message_text)
+        def delivered(text, error):
+            if error is not None:
+                self.send(message.frm, "Couldn't deliver \"%s\": %s" %
+                          (text, error))
+        try:
+            chat.queue_message(message_text, delivered, timeout=10)
+        except ucwa.OutboxFull:
+            self.send(message.frm, "Slow down - still sending your "
+                      "earlier messages.", in_reply_to=message)
+
+    def trace_span(self, name, **tags):
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, **tags)
+
+    def session_options(self):
+        """Keyword arguments for every LyncUCWA this plugin creates."""
+        return dict(transport=self.transport,
+                    async_transport=self.mux.http,
+                    cache_size=self.get_config('CACHE_SIZE'),
+                    cache_ttl=self.get_config('CACHE_TTL'),
+                    session_store=self.session_store,
+                    rate_limit=self.get_config('USER_RATE_LIMIT'),
+                    host_limiter=self.host_limiter,
+                    tracer=self.tracer,
+                    recorder=self.recorder)
+
+    def new_session(self, email, password=None):
+        """Logs in, or resumes a stored session without a password, in
+        this process or in the user's shard."""
+        if self.shards is not None:
+            return self.shards.login(email, password)
+        return ucwa.LyncUCWA(email, password, **self.session_options())
 
     def lync_login(self, chatname, email, password):
         try:
-            u = ucwa.LyncUCWA(email, password)
+            with self.trace_span('login', chatname=chatname):
+                u = self.new_session(email, password)
         except:
             return False
+        if self.session_store is not None:
+            logins = self.get('logins', {})
+            logins[chatname] = email
+            self['logins'] = logins
+        self.start_session(chatname, u)
+        return True
+
+    def resume_sessions(self):
+        """Picks up the Lync sessions of users who logged in before the
+        last restart, as long as their tokens are still good."""
+        logins = self.get('logins', {})
+        for chatname, email in list(logins.items()):
+            try:
+                u = self.new_session(email)
+            except Exception as e:
+                self.log.info("could not resume %s: %s" % (email, e))
+                del logins[chatname]
+                continue
+            self.start_session(chatname, u)
+        self['logins'] = logins
+
+    def start_session(self, chatname, u):
         self.conns[chatname] = u
         self.chats[chatname] = {}
 
@@ -74,11 +235,9 @@ class Lyncbot(BotPlugin, web.WebInterface):
         # make available
         u.set_available()
         
-        # launch the event listener in a background thread
-        u.thread = threading.Thread(target=u.process_events)
-        u.thread.setDaemon(True)
-        u.thread.start()
-        return True
+        # listen for events on the shared event loop; shards have their own
+        if self.shards is None:
+            self.mux.add(u)
 
     def add_chat(self, chat, to):
         self.chats[to][chat.other[0]] = chat
@@ -97,6 +256,7 @@ class Lyncbot(BotPlugin, web.WebInterface):
         return frm
             
     @botcmd
+    @traced
     def contacts(self, message, args):
         """Displays a list of people to contact."""
         frm = self.get_from(message)
@@ -109,15 +269,16 @@ class Lyncbot(BotPlugin, web.WebInterface):
             'IdleOnline': ':eight_spoked_asterisk:',
             'IdleBusy': ':clock1030:'
         }
-        for c in self.conns[frm].contacts(args or None):
-            yield "%s %s (%s)" % (status.get(c.contactPresence.availability,
-                                             ':question:'),
-                                  c.name, c.emailAddresses[0])
+        u = self.conns[frm]
+        for availability, name, email in u.contact_summaries(args or None):
+            yield "%s %s (%s)" % (status.get(availability, ':question:'),
+                                  name, email)
         else:
             return "No contacts found" + (" under " + " ".join(args)
                                           if args else "")
         
     @botcmd
+    @traced
     def chat_with(self, message, args):
         """Starts a chat session with the desired recipient."""
         frm = self.get_from(message)
@@ -133,23 +294,63 @@ class Lyncbot(BotPlugin, web.WebInterface):
         return "Go ahead!"
 
     @botcmd
+    @traced
     def chat_end(self, message, args):
         """Ends the current chat session or one specified."""
         frm = self.get_from(message)
+        chats = self.chats.get(frm, {})
         if args:
             other = self.conns[frm].normalize_contact(args)
         else:
             chat = self.current_chat.get(frm)
             try:
-                other = [k for k, v in self.conns[frm].items() if v == chat][0]
+                other = [k for k, v in chats.items() if v is chat][0]
             except IndexError:
                 return "No chat open..."
-        if self.conns[frm][other] == self.current_chat[frm]:
+        chat = chats.pop(other, None)
+        if chat is None:
+            return "No chat open with %s." % other
+        if self.current_chat.get(frm) is chat:
             del(self.current_chat[frm])
-        self.conns[frm][other].close()
-        del(self.conns[frm][other])
+        # stops routing its inbound messages
+        chat.close()
         return "Chat with %s closed." % other
     
+    def render_metrics(self):
+        """Current metrics in Prometheus text format."""
+        for gauge in (metrics.OUTBOX_DEPTH, metrics.CONVERSATIONS,
+                      metrics.LISTENER_UP):
+            gauge.clear()
+        for chatname, u in list(self.conns.items()):
+            chats = list(self.chats.get(chatname, {}).values())
+            metrics.OUTBOX_DEPTH.labels(u.username).set(
+                sum(self.outbox_depth(chat) for chat in chats))
+            metrics.CONVERSATIONS.labels(u.username).set(len(chats))
+            metrics.LISTENER_UP.labels(u.username).set(int(
+                self.listening(u)))
+        metrics.SESSIONS.labels().set(len(self.conns))
+        return metrics.REGISTRY.render()
+
+    def listening(self, u):
+        """Whether the event channel of session `u` is being read; a shard
+        that can't answer counts as not listening."""
+        if self.shards is None:
+            return self.mux.listening(u)
+        try:
+            return u.listening()
+        except sharding.RemoteError:
+            return False
+
+    def outbox_depth(self, chat):
+        """Messages queued on `chat`; a shard that can't answer counts as
+        having none."""
+        if self.shards is None:
+            return chat.outbox_depth()
+        try:
+            return chat.outbox_depth()
+        except sharding.RemoteError:
+            return 0
+
     def inbound_chat_message(self, message, to):
         """Posts an inbound chat message to the Errbot user."""
         self.send(to, message)
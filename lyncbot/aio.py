@@ -0,0 +1,255 @@
+import io
+import ssl
+import time
+import asyncio
+import logging
+import threading
+from email.parser import Parser
+from http.client import HTTPMessage
+from urllib.error import HTTPError
+from urllib.parse import urlparse, urljoin
+
+from lyncbot.transport import HTTPPool
+
+log = logging.getLogger(__name__)
+
+
+class AsyncResponse:
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class AsyncHTTP:
+    """Minimal HTTP/1.1 client on top of asyncio streams, keeping up to
+    `maxsize` idle keep-alive connections per host.  It is the asyncio
+    counterpart of transport.HTTPPool and must only be used from one event
+    loop."""
+    MAX_REDIRECTS = 5
+
+    def __init__(self, maxsize=4, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+
+    async def _get(self, key):
+        scheme, host, port = key
+        now = time.time()
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, since = idle.pop()
+            if now - since < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        ctx = ssl._create_default_https_context() if scheme == 'https' \
+            else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=ctx)
+        return reader, writer, False
+
+    def _put(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    def clear(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for reader, writer, since in conns:
+                writer.close()
+
+    async def request(self, method, url, body=None, headers=None):
+        """Performs a request, following redirects, and returns an
+        AsyncResponse with the body fully read.  HTTP errors raise
+        HTTPError like urlopen does."""
+        headers = dict(headers or {})
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = await self._send(method, url, body, headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                if response.status == 303 or (
+                        response.status in (301, 302) and method == 'POST'):
+                    method, body = 'GET', None
+                continue
+            break
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.body))
+        return response
+
+    async def _send(self, method, url, body, headers):
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s' % parsed.netloc]
+        for name, value in headers.items():
+            if name.lower() not in ('host', 'content-length', 'connection'):
+                lines.append('%s: %s' % (name, value))
+        if body is not None or method in ('POST', 'PUT'):
+            lines.append('Content-Length: %d' % len(body or b''))
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        while True:
+            reader, writer, reused = await self._get(key)
+            sent = False
+            try:
+                writer.write(head + (body or b''))
+                await writer.drain()
+                sent = True
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("connection closed")
+                response, keep_alive = await self._read_response(
+                    url, status_line, reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and (not sent or
+                               method in HTTPPool.IDEMPOTENT_METHODS):
+                    # the server probably closed an idle connection on us
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._put(key, reader, writer)
+            else:
+                writer.close()
+            return response
+
+    async def _read_response(self, url, status_line, reader, method):
+        version, status, reason = (status_line.decode('latin-1').rstrip(
+            '\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+        raw = b''
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            raw += line
+        headers = Parser(_class=HTTPMessage).parsestr(raw.decode('latin-1'))
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('Connection', '').lower() != 'close'
+
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return AsyncResponse(url, status, reason, headers, body), keep_alive
+
+
+class EventMultiplexer:
+    """Drives the event channels of many LyncUCWA sessions from a single
+    asyncio loop running in one background thread, instead of one thread
+    per session.
+
+    Event callbacks are ordinary blocking functions, so each batch is
+    dispatched in a small shared thread pool to keep them from stalling
+    the other sessions' long-polls.
+    """
+    def __init__(self, http=None):
+        self.loop = asyncio.new_event_loop()
+        self.http = http if http is not None else AsyncHTTP()
+        self.tasks = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='lyncbot-events')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.submit(self._shutdown()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
+        self.loop.close()
+
+    async def _shutdown(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.http.clear()
+
+    def submit(self, coro):
+        """Schedules a coroutine on the loop from any thread, returning a
+        concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def add(self, ucwa):
+        """Starts listening to the events of `ucwa`."""
+        if ucwa.async_transport is None:
+            ucwa.async_transport = self.http
+        ucwa.event_loop = self.loop
+
+        def _add():
+            self.tasks[id(ucwa)] = self.loop.create_task(self._listen(ucwa))
+        self.loop.call_soon_threadsafe(_add)
+
+    def remove(self, ucwa):
+        ucwa.event_loop = None
+
+        def _remove():
+            task = self.tasks.pop(id(ucwa), None)
+            if task is not None:
+                task.cancel()
+        self.loop.call_soon_threadsafe(_remove)
+
+    def listening(self, ucwa):
+        """Whether the event channel of `ucwa` is still being read."""
+        task = self.tasks.get(id(ucwa))
+        return task is not None and not task.done()
+
+    async def _listen(self, ucwa):
+        try:
+            await ucwa.aprocess_events()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("event listener died")
+        finally:
+            self.tasks.pop(id(ucwa), None)
+            # removed, stopped or died: don't leave it to the throttled saves
+            try:
+                ucwa.save_cursor(force=True)
+            except Exception:
+                log.exception("saving the event cursor failed")
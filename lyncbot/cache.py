@@ -0,0 +1,86 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe mapping bounded to `maxsize` entries, evicting the least
+    recently used one when full.  Entries expire `ttl` seconds after they
+    were set, but expired entries are kept until evicted so callers can
+    still revalidate them (e.g. with an ETag)."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.lookup(key)[1]
+
+    def lookup(self, key):
+        """Returns (value, fresh), or (None, False) on a miss."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None, False
+            self._data.move_to_end(key)
+            return value, expires > time.time()
+
+    def get(self, key, default=None):
+        value, fresh = self.lookup(key)
+        return value if fresh else default
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class CoalescingCache(TTLCache):
+    """TTLCache whose loads are coalesced: when many threads miss on the
+    same key at once, only one of them runs the loader and the rest wait
+    for its result."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        TTLCache.__init__(self, maxsize, ttl)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def get_or_load(self, key, load):
+        while True:
+            value, fresh = self.lookup(key)
+            if fresh:
+                return value
+            with self._inflight_lock:
+                done = self._inflight.get(key)
+                loading = done is None
+                if loading:
+                    done = self._inflight[key] = threading.Event()
+            if not loading:
+                # if the loader failed, the next waiter takes over
+                done.wait()
+                continue
+            try:
+                value = load()
+                self.set(key, value)
+                return value
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+                done.set()
@@ -0,0 +1,103 @@
+import threading
+import itertools
+
+
+class ContactIndex:
+    """In-memory index over a contact list: a trie on lowercased display
+    names for prefix lookups, plus hash maps by email address and href."""
+
+    def __init__(self, contacts=()):
+        self._root = {}
+        self._by_href = {}
+        self._by_email = {}
+        self._order = {}
+        # the name and emails each contact was indexed under; contacts are
+        # shared resources that may change before they are removed
+        self._keys = {}
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+        for contact in contacts:
+            self.add(contact)
+
+    @staticmethod
+    def _href(contact):
+        return contact['_links']['self']['href']
+
+    def __len__(self):
+        return len(self._by_href)
+
+    def __contains__(self, href):
+        return href in self._by_href
+
+    def __iter__(self):
+        with self._lock:
+            return iter(self._sorted(self._by_href))
+
+    def _sorted(self, hrefs):
+        # keep the order the server listed the contacts in
+        return [self._by_href[h] for h in sorted(hrefs,
+                                                 key=self._order.get)]
+
+    def add(self, contact):
+        """Adds a contact, replacing any previous version of it."""
+        href = self._href(contact)
+        with self._lock:
+            order = self._order.get(href)
+            self.remove(href)
+            self._order[href] = next(self._seq) if order is None else order
+            self._by_href[href] = contact
+            name = contact.get('name', '').lower()
+            emails = tuple(contact.get('emailAddresses', []))
+            self._keys[href] = (name, emails)
+            node = self._root
+            for ch in name:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, set()).add(href)
+            for email in emails:
+                self._by_email.setdefault(email, set()).add(href)
+
+    def remove(self, href):
+        with self._lock:
+            if self._by_href.pop(href, None) is None:
+                return
+            del self._order[href]
+            name, emails = self._keys.pop(href)
+            path = [self._root]
+            for ch in name:
+                path.append(path[-1][ch])
+            path[-1][None].discard(href)
+            if not path[-1][None]:
+                del path[-1][None]
+            # prune branches that no longer lead to any contact
+            for ch, node in zip(reversed(name), reversed(path[:-1])):
+                if node[ch]:
+                    break
+                del node[ch]
+            for email in emails:
+                hrefs = self._by_email.get(email, set())
+                hrefs.discard(href)
+                if not hrefs:
+                    self._by_email.pop(email, None)
+
+    def prefix(self, query):
+        """Contacts whose name starts with `query`, case-insensitively."""
+        with self._lock:
+            node = self._root
+            for ch in query.lower():
+                node = node.get(ch)
+                if node is None:
+                    return []
+            hrefs = []
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                for key, child in node.items():
+                    if key is None:
+                        hrefs.extend(child)
+                    else:
+                        stack.append(child)
+            return self._sorted(hrefs)
+
+    def email(self, address):
+        with self._lock:
+            return self._sorted(self._by_email.get(address, ()))
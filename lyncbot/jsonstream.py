@@ -0,0 +1,124 @@
+import json
+import codecs
+
+_WHITESPACE = ' \t\r\n'
+_decoder = json.JSONDecoder()
+
+
+class StreamDecoder:
+    """Incrementally decodes a JSON document from a binary file-like
+    object, handing out the values found at a given path one at a time as
+    the bytes arrive instead of loading the whole document first.
+
+    Paths are tuples of object keys, with '*' standing for every element
+    of an array; ('sender', '*', 'events', '*') walks each event of each
+    sender of a UCWA events page.  Members of the objects along the way
+    that are not on the path are decoded whole and collected in context
+    dicts, the outermost of which is `root`.
+    """
+
+    def __init__(self, fp, chunk_size=16384):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.root = {}
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self._eof = True
+        self._buf = self._buf[self._pos:] + self._utf8.decode(data,
+                                                              not data)
+        self._pos = 0
+
+    def _peek(self):
+        while True:
+            buf, pos = self._buf, self._pos
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if self._eof:
+                raise ValueError("unexpected end of JSON stream")
+            self._fill()
+
+    def _next(self, expected):
+        ch = self._peek()
+        if ch not in expected:
+            raise ValueError("expected one of %r, got %r" % (expected, ch))
+        self._pos += 1
+        return ch
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._fill()
+                continue
+            if end == len(self._buf) and not self._eof:
+                # a number at the end of the buffer may go on in the next
+                # chunk
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+    def iter_path(self, path):
+        """Yields (contexts, value) for each value at `path`, where
+        `contexts` holds the context dict of each object on the way."""
+        for item in self._walk(tuple(path), []):
+            yield item
+        # read to the end so the connection can be reused
+        while not self._eof:
+            self._fill()
+
+    def _walk(self, path, contexts):
+        if not path:
+            yield contexts, self._value()
+            return
+        key, rest = path[0], path[1:]
+        if key == '*':
+            if self._peek() != '[':
+                self._value()
+                return
+            self._pos += 1
+            if self._peek() == ']':
+                self._pos += 1
+                return
+            while True:
+                for item in self._walk(rest, contexts):
+                    yield item
+                if self._next(',]') == ']':
+                    return
+        else:
+            if self._peek() != '{':
+                self._value()
+                return
+            self._pos += 1
+            members = self.root if not contexts else {}
+            contexts = contexts + [members]
+            if self._peek() == '}':
+                self._pos += 1
+                return
+            while True:
+                name = self._value()
+                self._next(':')
+                if name == key:
+                    for item in self._walk(rest, contexts):
+                        yield item
+                else:
+                    members[name] = self._value()
+                if self._next(',}') == '}':
+                    return
+
+
+def iter_path(fp, path, chunk_size=16384):
+    return StreamDecoder(fp, chunk_size).iter_path(path)
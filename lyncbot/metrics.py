@@ -0,0 +1,203 @@
+import re
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """The child metric for one combination of label values; keep it
+        around to skip the lookup on hot paths."""
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s takes labels %s" % (self.name,
+                                                     self.labelnames))
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._child()
+            return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def clear(self):
+        with self._lock:
+            self._children.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.doc),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _child = _Value
+
+    def _render_child(self, values, child):
+        yield '%s%s %s' % (self.name, _format_labels(self.labelnames, values),
+                           _format_value(child.value))
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, doc, labelnames=(), buckets=BUCKETS):
+        _Metric.__init__(self, name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (
+                self.name, _format_labels(self.labelnames, values,
+                                          [('le', _format_value(bound))]),
+                cumulative)
+        labels = _format_labels(self.labelnames, values)
+        yield '%s_sum%s %s' % (self.name, labels, _format_value(total))
+        yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        """Everything in Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+_ID_RE = re.compile(r'^[A-Za-z]+$')
+
+
+def resource_type(url):
+    """A low-cardinality name for the resource at `url`: its last path
+    segment that looks like a UCWA resource name rather than an id or an
+    address, e.g. 'presence' for .../people/bob@example.com/presence."""
+    path = url.split('?', 1)[0].split('#', 1)[0]
+    for segment in reversed(path.split('/')):
+        if _ID_RE.match(segment):
+            return segment
+    return 'other'
+
+
+REGISTRY = Registry()
+
+HTTP_DURATION = REGISTRY.histogram(
+    'lyncbot_http_request_duration_seconds',
+    "Time taken by UCWA HTTP requests, by resource type.",
+    ('user', 'resource', 'method'))
+HTTP_ERRORS = REGISTRY.counter(
+    'lyncbot_http_errors_total',
+    "UCWA HTTP requests that failed, by status (0 for network errors).",
+    ('user', 'resource', 'status'))
+EVENTS_RECEIVED = REGISTRY.counter(
+    'lyncbot_events_received_total',
+    "Events read off the UCWA event channel.", ('user',))
+EVENTS_DISPATCHED = REGISTRY.counter(
+    'lyncbot_events_dispatched_total',
+    "Events handed to at least one callback.", ('user',))
+CALLBACK_DURATION = REGISTRY.histogram(
+    'lyncbot_callback_duration_seconds',
+    "Time spent in event callbacks.", ('user',))
+OUTBOX_DEPTH = REGISTRY.gauge(
+    'lyncbot_outbox_depth',
+    "Chat messages waiting to be sent.", ('user',))
+CONVERSATIONS = REGISTRY.gauge(
+    'lyncbot_active_conversations',
+    "Open chat conversations.", ('user',))
+LISTENER_UP = REGISTRY.gauge(
+    'lyncbot_event_listener_up',
+    "1 while the user's event channel is being listened to.", ('user',))
+SESSIONS = REGISTRY.gauge(
+    'lyncbot_sessions', "Logged in Lync sessions.")
@@ -0,0 +1,247 @@
+"""
+Recording and offline replay of UCWA traffic.
+
+A Recorder handed to LyncUCWA writes what the session reads off the wire
+to a gzipped JSON lines file: the application at login, each page of the
+event channel, and the JSON of each resource fetched.  Recordings hold
+message text and contact details but never credentials.
+
+A Replayer feeds a recording back through LyncUCWA's dispatch and
+UCWAResource code as fast as it will go, serving the recorded GETs from
+memory instead of the network, to profile event handling against real
+traffic:
+
+    python -m lyncbot.recorder events.jsonl.gz --touch
+"""
+
+import io
+import gzip
+import json
+import time
+import logging
+import argparse
+import threading
+
+try:
+    from urllib.error import HTTPError
+    from urllib.parse import urlparse
+except ImportError:
+    from urllib2 import HTTPError
+    from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+class Recorder:
+    """Appends the traffic of any number of sessions to `path`, one
+    record per line, tagged with the session's username."""
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self.records += 1
+
+    def session(self, ucwa):
+        self._write({'t': time.time(), 'user': ucwa.username,
+                     'appbase': ucwa.appbase,
+                     'application': ucwa.application_json})
+
+    def page(self, ucwa, href, page):
+        self._write({'t': time.time(), 'user': ucwa.username,
+                     'page': href, 'json': page})
+
+    def get(self, ucwa, href, data):
+        self._write({'t': time.time(), 'user': ucwa.username,
+                     'get': href, 'json': data})
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read(path):
+    """Yields the records of a recording in order."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class _Response:
+    def __init__(self, url, status, data=None):
+        self.url = url
+        self.status = status
+        self.reason = 'OK'
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.headers = {'Content-Length': str(len(body))}
+        if data is not None:
+            self.headers['Content-Type'] = 'application/json'
+        self._body = io.BytesIO(body)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+
+class ReplayTransport:
+    """Stands in for HTTPPool, answering GETs with the latest recorded
+    JSON for their href and anything else with an empty 204."""
+    def __init__(self):
+        self.resources = {}
+        self.hits = 0
+        self.misses = 0
+
+    def urlopen(self, req):
+        url = req.full_url
+        if req.get_method() != 'GET':
+            return _Response(url, 204)
+        parsed = urlparse(url)
+        href = parsed.path + ('?' + parsed.query if parsed.query else '')
+        data = self.resources.get(href)
+        if data is None:
+            self.misses += 1
+            raise HTTPError(url, 404, 'not recorded', {}, None)
+        self.hits += 1
+        return _Response(url, 200, data)
+
+    def clear(self):
+        pass
+
+
+class _ReplayStore:
+    """Just enough of a SessionStore to resume a recorded application."""
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, username):
+        return self.session
+
+    def put(self, username, session):
+        pass
+
+    def update(self, username, **fields):
+        pass
+
+    def delete(self, username):
+        pass
+
+
+class Replayer:
+    """Replays a recording through one LyncUCWA per recorded user.
+
+    `setup(ucwa)` is called for each session as it is created, to register
+    the callbacks to exercise.  Each event page is dispatched once the GETs
+    recorded after it, which its callbacks made, are loaded."""
+    def __init__(self, path, setup=None, **session_options):
+        self.path = path
+        self.setup = setup
+        self.session_options = session_options
+        self.transport = ReplayTransport()
+        self.sessions = {}
+
+    def _session(self, record):
+        from lyncbot import ucwa
+        application = record['application']
+        href = application['_links']['self']['href']
+        self.transport.resources[href] = application
+        u = ucwa.LyncUCWA(record['user'], transport=self.transport,
+                          session_store=_ReplayStore({
+                              'auth_headers': {'Authorization': 'replay'},
+                              'expires': float('inf'),
+                              'user_url': None,
+                              'appbase': record['appbase'],
+                              'application': href}),
+                          **self.session_options)
+        if self.setup is not None:
+            self.setup(u)
+        return u
+
+    def run(self):
+        """Replays the whole recording, returning (pages, events,
+        seconds spent dispatching)."""
+        pages = events = 0
+        elapsed = 0.0
+        pending = None
+        for record in read(self.path):
+            if 'application' in record:
+                self.sessions[record['user']] = self._session(record)
+            elif 'get' in record:
+                self.transport.resources[record['get']] = record['json']
+            elif 'page' in record:
+                if pending is not None:
+                    elapsed += self._dispatch(pending)
+                pending = record
+                pages += 1
+                events += sum(len(s['events'])
+                              for s in record['json'].get('sender', ()))
+        if pending is not None:
+            elapsed += self._dispatch(pending)
+        return pages, events, elapsed
+
+    def _dispatch(self, record):
+        u = self.sessions.get(record['user'])
+        if u is None:
+            log.warning("no recorded session for %s" % record['user'])
+            return 0.0
+        start = time.time()
+        u._dispatch(record['json'], record['page'])
+        return time.time() - start
+
+
+def touch(u, event):
+    """A callback doing what most handlers do: reading the resource the
+    event is about, fetching it if the event didn't embed it."""
+    if event['type'] == 'deleted':
+        return
+    resource = getattr(event, event['link']['rel'], None)
+    try:
+        getattr(resource, '_links', None)
+    except HTTPError:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded UCWA event stream offline.")
+    parser.add_argument('path')
+    parser.add_argument('--touch', action='store_true',
+                        help="read the resource of every event, as "
+                        "handlers usually do")
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    def setup(u):
+        if args.touch:
+            for rel in ('communication', 'conversation', 'people', 'me'):
+                u.register_callback(touch, rel)
+    for i in range(args.repeat):
+        replayer = Replayer(args.path, setup)
+        pages, events, elapsed = replayer.run()
+        print("%d sessions, %d pages, %d events in %.3fs = %.0f events/s "
+              "(%d GETs served, %d not recorded)" % (
+                  len(replayer.sessions), pages, events, elapsed,
+                  events / elapsed if elapsed else 0,
+                  replayer.transport.hits, replayer.transport.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SessionStore:
+    """Encrypted on-disk store of live UCWA sessions (OAuth token, expiry,
+    user/application URLs), keyed by username, so a restarted bot can pick
+    its applications back up without anyone re-entering a password.
+
+    The file is encrypted with Fernet from the optional `cryptography`
+    package; use `SessionStore.generate_key()` to make a key.
+    """
+
+    def __init__(self, path, key):
+        if Fernet is None:
+            raise RuntimeError("SessionStore requires the cryptography "
+                               "package")
+        self.path = path
+        self._fernet = Fernet(key)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def generate_key():
+        if Fernet is None:
+            raise RuntimeError("SessionStore requires the cryptography "
+                               "package")
+        return Fernet.generate_key().decode('ascii')
+
+    @contextmanager
+    def _locked(self):
+        """Serializes access between threads and, where flock is
+        available, between the processes of a ShardPool sharing the file."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                token = f.read()
+        except (IOError, OSError):
+            return {}
+        try:
+            return json.loads(self._fernet.decrypt(token).decode('utf-8'))
+        except (InvalidToken, ValueError):
+            log.warning("ignoring unreadable session store %s" % self.path)
+            return {}
+
+    def _save(self, sessions):
+        token = self._fernet.encrypt(json.dumps(sessions).encode('utf-8'))
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(token)
+        os.replace(tmp, self.path)
+
+    def get(self, username):
+        with self._locked():
+            return self._load().get(username)
+
+    def put(self, username, session):
+        with self._locked():
+            sessions = self._load()
+            sessions[username] = session
+            self._save(sessions)
+
+    def update(self, username, **fields):
+        """Changes some fields of a stored session, if there is one."""
+        with self._locked():
+            sessions = self._load()
+            if username in sessions:
+                sessions[username].update(fields)
+                self._save(sessions)
+
+    def delete(self, username):
+        with self._locked():
+            sessions = self._load()
+            if sessions.pop(username, None) is not None:
+                self._save(sessions)
@@ -0,0 +1,431 @@
+"""
+Optional multi-process hosting of Lync sessions.
+
+A ShardPool runs a number of worker processes, each owning the LyncUCWA
+sessions of the users hashed to it, so JSON parsing and resource building
+for many users are spread over several cores instead of sharing one GIL.
+The bot process holds a RemoteSession proxy per user, which forwards
+commands and outbound messages to the worker over a multiprocessing pipe
+and receives inbound messages and invitations back as events.
+"""
+
+import bisect
+import hashlib
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+
+class RemoteError(Exception):
+    pass
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, so adding or removing a node
+    only moves the keys of its neighbours on the ring."""
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self._hash('%s-%d' % (node, i))
+            self._nodes[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            point = self._hash('%s-%d' % (node, i))
+            if self._nodes.pop(point, None) is not None:
+                self._points.remove(point)
+
+    def node_for(self, key):
+        if not self._points:
+            raise KeyError("empty hash ring")
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[i]]
+
+
+# -- worker process --------------------------------------------------------
+
+class Worker:
+    """Owns the sessions of one shard, serving requests from the pipe on a
+    small thread pool so one slow login doesn't hold up the others."""
+    def __init__(self, conn, options):
+        from lyncbot import ucwa, transport, aio, session, recorder, trace
+        self.ucwa = ucwa
+        self.conn = conn
+        if options.get('discover_url'):
+            ucwa.LyncUCWA.DISCOVER_URL = options['discover_url']
+        self.transport = transport.HTTPPool(
+            maxsize=options.get('pool_size', 4),
+            idle_timeout=options.get('pool_idle_timeout', 60))
+        self.mux = aio.EventMultiplexer(aio.AsyncHTTP(
+            maxsize=options.get('pool_size', 4),
+            idle_timeout=options.get('pool_idle_timeout', 60))).start()
+        self.session_options = dict(
+            transport=self.transport, async_transport=self.mux.http,
+            cache_size=options.get('cache_size', 1024),
+            cache_ttl=options.get('cache_ttl', 60),
+            rate_limit=options.get('rate_limit'))
+        if options.get('server_rate_limit'):
+            self.session_options['host_limiter'] = transport.HostLimiter(
+                options['server_rate_limit'])
+        if options.get('session_store') and options.get('session_key'):
+            self.session_options['session_store'] = session.SessionStore(
+                options['session_store'], options['session_key'])
+        shard = options.get('shard', 0)
+        if options.get('tracing') or options.get('trace_file'):
+            self.session_options['tracer'] = trace.Tracer(
+                options.get('trace_file') and
+                '%s.%d' % (options['trace_file'], shard))
+        self.recorder = None
+        if options.get('record_file'):
+            self.recorder = self.session_options['recorder'] = \
+                recorder.Recorder('%s.%d' % (options['record_file'], shard))
+        self.sessions = {}
+        self.chats = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(options.get('threads', 8))
+
+    def run(self):
+        while True:
+            try:
+                call_id, op, args = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if op == 'stop':
+                self._send(('reply', call_id, True, None))
+                break
+            self.executor.submit(self._handle, call_id, op, args)
+        self.executor.shutdown(wait=False)
+        self.mux.stop()
+        self.transport.clear()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _handle(self, call_id, op, args):
+        try:
+            result = getattr(self, 'op_' + op)(*args)
+            reply = ('reply', call_id, True, result)
+        except Exception as e:
+            # the caller gets the error; it decides whether it's news
+            log.debug("%s failed" % op, exc_info=True)
+            reply = ('reply', call_id, False, (type(e).__name__, str(e)))
+        self._send(reply)
+
+    def _emit(self, username, kind, *args):
+        self._send(('event', username, kind, args))
+
+    def _register(self, username, chat):
+        conv_id = next(self._ids)
+        self.chats[conv_id] = (username, chat)
+        chat.set_inbound_callback(
+            lambda message: self._emit(username, 'message', conv_id, message))
+        return conv_id
+
+    def _invited(self, username, chat):
+        conv_id = self._register(username, chat)
+        self._emit(username, 'invited', conv_id, chat.other)
+
+    def op_login(self, username, password):
+        u = self.ucwa.LyncUCWA(username, password, **self.session_options)
+        self.sessions[username] = u
+        u.set_invitation_callback(lambda chat: self._invited(username, chat))
+        self.mux.add(u)
+
+    def op_logout(self, username):
+        u = self.sessions.pop(username, None)
+        if u is None:
+            return
+        self.mux.remove(u)
+        for conv_id, (owner, chat) in list(self.chats.items()):
+            if owner == username:
+                chat.close()
+                del self.chats[conv_id]
+
+    def op_set_available(self, username, avail):
+        self.sessions[username].set_available(avail)
+
+    def op_normalize_contact(self, username, name):
+        return self.sessions[username].normalize_contact(name)
+
+    def op_contact_summaries(self, username, query):
+        return self.sessions[username].contact_summaries(query)
+
+    def op_listening(self, username):
+        u = self.sessions.get(username)
+        return u is not None and self.mux.listening(u)
+
+    def op_open_chat(self, username, other):
+        chat = self.sessions[username].new_conversation(other)
+        return self._register(username, chat)
+
+    def op_queue_message(self, conv_id, message, msg_id, timeout):
+        username, chat = self.chats[conv_id]
+
+        def delivered(text, error):
+            self._emit(username, 'delivered', conv_id, msg_id,
+                       None if error is None else str(error))
+        chat.queue_message(message, delivered, timeout)
+
+    def op_outbox_depth(self, conv_id):
+        return self.chats[conv_id][1].outbox_depth()
+
+    def op_close_chat(self, conv_id):
+        username, chat = self.chats.pop(conv_id)
+        chat.close()
+
+
+def _worker_main(conn, options):
+    logging.basicConfig(level=options.get('log_level', logging.INFO))
+    Worker(conn, options).run()
+
+
+# -- bot process -----------------------------------------------------------
+
+class Shard:
+    """The bot's end of the pipe to one worker process."""
+    TIMEOUT = 60
+
+    def __init__(self, ctx, index, options):
+        self.index = index
+        self.conn, child = ctx.Pipe()
+        options = dict(options, shard=index)
+        self.process = ctx.Process(target=_worker_main, args=(child, options),
+                                   name='lyncbot-shard-%d' % index)
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.sessions = {}
+        self.stopping = False
+        self._calls = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        # events are handled off the reader thread, so their callbacks may
+        # make calls of their own
+        self._events = queue.Queue()
+        for target in (self._read, self._handle_events):
+            thread = threading.Thread(target=target,
+                                      name='lyncbot-shard-%d' % index)
+            thread.daemon = True
+            thread.start()
+
+    def call(self, op, *args, **kwargs):
+        timeout = kwargs.get('timeout', self.TIMEOUT)
+        call_id = next(self._ids)
+        waiter = self._calls[call_id] = [threading.Event(), None]
+        try:
+            with self._send_lock:
+                try:
+                    self.conn.send((call_id, op, args))
+                except (OSError, ValueError):
+                    raise RemoteError("shard %d is gone" % self.index)
+            if not waiter[0].wait(timeout):
+                raise RemoteError("shard %d timed out on %s" %
+                                  (self.index, op))
+        finally:
+            self._calls.pop(call_id, None)
+        ok, result = waiter[1]
+        if ok:
+            return result
+        name, message = result
+        if name == 'OutboxFull':
+            from lyncbot.ucwa import OutboxFull
+            raise OutboxFull(message)
+        if name == 'Exception':
+            raise RemoteError(message)
+        raise RemoteError("%s: %s" % (name, message))
+
+    def _read(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'reply':
+                waiter = self._calls.get(message[1])
+                if waiter is not None:
+                    waiter[1] = message[2:]
+                    waiter[0].set()
+            else:
+                self._events.put(message[1:])
+        if not self.stopping:
+            log.warning("shard %d went away" % self.index)
+        for waiter in list(self._calls.values()):
+            waiter[1] = (False, ('RemoteError', 'shard process exited'))
+            waiter[0].set()
+        self._events.put(None)
+
+    def _handle_events(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            username, kind, args = event
+            session = self.sessions.get(username)
+            if session is None:
+                continue
+            try:
+                session._event(kind, args)
+            except Exception:
+                log.exception("handling %s event for %s failed" %
+                              (kind, username))
+
+    def stop(self, timeout=10):
+        self.stopping = True
+        try:
+            self.call('stop', timeout=timeout)
+        except RemoteError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ShardPool:
+    """`shards` worker processes owning the Lync sessions, with users
+    assigned to them by consistent hashing of their username.  `options`
+    configure the sessions in the workers: pool_size, pool_idle_timeout,
+    cache_size, cache_ttl, rate_limit, server_rate_limit (per worker),
+    session_store, session_key, record_file (suffixed with the shard
+    number) and discover_url."""
+    def __init__(self, shards, options=None):
+        # fork is unsafe in a process already running threads
+        ctx = multiprocessing.get_context('spawn')
+        self.shards = [Shard(ctx, i, dict(options or {}))
+                       for i in range(shards)]
+        self.ring = HashRing(range(shards))
+
+    def shard_for(self, username):
+        return self.shards[self.ring.node_for(username)]
+
+    def login(self, username, password=None):
+        """Starts (or resumes, without a password) a session in its shard
+        and returns the RemoteSession for it."""
+        shard = self.shard_for(username)
+        shard.call('login', username, password)
+        return RemoteSession(shard, username)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+
+class RemoteSession:
+    """Stands in for the LyncUCWA of a user living in a shard, with the
+    subset of its interface the plugin uses."""
+    def __init__(self, shard, username):
+        self.shard = shard
+        self.username = username
+        self.invitation_callback = None
+        self.chats = {}
+        shard.sessions[username] = self
+
+    def _call(self, op, *args, **kwargs):
+        return self.shard.call(op, self.username, *args, **kwargs)
+
+    def set_available(self, avail=True):
+        self._call('set_available', avail)
+
+    def normalize_contact(self, name):
+        return self._call('normalize_contact', name)
+
+    def contact_summaries(self, query=None):
+        return self._call('contact_summaries', query)
+
+    def listening(self, timeout=5):
+        return self._call('listening', timeout=timeout)
+
+    def new_conversation(self, other):
+        if not isinstance(other, list):
+            other = [other]
+        conv_id = self._call('open_chat', other)
+        return self._conversation(conv_id, other)
+
+    def set_invitation_callback(self, cb):
+        self.invitation_callback = cb
+
+    def close(self):
+        self.shard.sessions.pop(self.username, None)
+        self._call('logout')
+
+    def _conversation(self, conv_id, other):
+        chat = self.chats[conv_id] = RemoteConversation(self, conv_id, other)
+        return chat
+
+    def _event(self, kind, args):
+        if kind == 'invited':
+            conv_id, other = args
+            chat = self._conversation(conv_id, other)
+            if self.invitation_callback is not None:
+                self.invitation_callback(chat)
+        elif kind == 'message':
+            conv_id, message = args
+            chat = self.chats.get(conv_id)
+            if chat is not None and chat.inbound_callback is not None:
+                chat.inbound_callback(message)
+        elif kind == 'delivered':
+            conv_id, msg_id, error = args
+            chat = self.chats.get(conv_id)
+            if chat is not None:
+                chat._delivered(msg_id, error)
+
+
+class RemoteConversation:
+    """Stands in for a UCWAConversation living in a shard."""
+    def __init__(self, session, conv_id, other):
+        self.session = session
+        self.conv_id = conv_id
+        self.other = other
+        self.inbound_callback = None
+        self._pending = {}
+        self._ids = itertools.count()
+
+    def set_inbound_callback(self, cb):
+        self.inbound_callback = cb
+
+    def queue_message(self, message, callback=None, timeout=None):
+        msg_id = next(self._ids)
+        self._pending[msg_id] = (message, callback)
+        try:
+            self.session.shard.call('queue_message', self.conv_id, message,
+                                    msg_id, timeout)
+        except Exception:
+            self._pending.pop(msg_id, None)
+            raise
+
+    def _delivered(self, msg_id, error):
+        message, callback = self._pending.pop(msg_id, (None, None))
+        if callback is not None:
+            callback(message, None if error is None else RemoteError(error))
+
+    def outbox_depth(self, timeout=5):
+        return self.session.shard.call('outbox_depth', self.conv_id,
+                                       timeout=timeout)
+
+    def close(self):
+        self.session.chats.pop(self.conv_id, None)
+        self.session.shard.call('close_chat', self.conv_id)
@@ -0,0 +1,103 @@
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# context variables rather than thread-locals, so spans also follow
+# coroutines on the event loop
+_current = contextvars.ContextVar('lyncbot_span', default=None)
+_stub_refresh = contextvars.ContextVar('lyncbot_stub_refresh', default=False)
+
+
+class Span:
+    """The HTTP calls made on behalf of one command, message or event."""
+    def __init__(self, tracer, name, parent=None, **tags):
+        self.tracer = tracer
+        self.name = name
+        self.id = uuid.uuid4().hex[:16]
+        if parent is None and _current.get() is not None:
+            parent = _current.get().id
+        self.parent = parent
+        self.tags = tags
+        self.calls = []
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current.reset(self._token)
+        self.duration = time.time() - self.start
+        if exc[0] is not None:
+            self.tags['error'] = repr(exc[1])
+        self.tracer.finish(self)
+
+    def record(self, method, url, status, nbytes, duration):
+        parsed = urlparse(url)
+        self.calls.append({
+            'method': method,
+            'href': parsed.path + ('?' + parsed.query if parsed.query else ''),
+            'status': status,
+            'bytes': nbytes,
+            'duration': duration,
+            'stub_refresh': _stub_refresh.get(),
+        })
+
+    def to_dict(self):
+        return {'id': self.id, 'parent': self.parent, 'name': self.name,
+                'tags': self.tags, 'start': self.start,
+                'duration': self.duration, 'calls': self.calls}
+
+
+class Tracer:
+    """Collects finished spans, keeping the last `keep` in memory and
+    appending each as a line of JSON to `path` if given."""
+    def __init__(self, path=None, keep=100):
+        self.path = path
+        self.recent = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def span(self, name, parent=None, **tags):
+        return Span(self, name, parent, **tags)
+
+    def finish(self, span):
+        self.recent.append(span)
+        if self.path is None:
+            return
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+def current():
+    """The span HTTP calls are being recorded under, if any."""
+    return _current.get()
+
+
+def record(method, url, status, nbytes, duration):
+    span = _current.get()
+    if span is not None:
+        span.record(method, url, status, nbytes, duration)
+
+
+@contextmanager
+def stub_refresh():
+    """Marks the HTTP calls made inside as stub refreshes."""
+    token = _stub_refresh.set(True)
+    try:
+        yield
+    finally:
+        _stub_refresh.reset(token)
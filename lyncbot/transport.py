@@ -0,0 +1,292 @@
+import io
+import ssl
+import time
+import select
+import random
+import threading
+import email.utils
+import logging
+
+log = logging.getLogger(__name__)
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.error import HTTPError
+    from urllib.request import Request
+    from urllib.parse import urlparse, urljoin
+except ImportError:
+    # for temporary py2/3 compatibility
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib2 import HTTPError, Request
+    from urlparse import urlparse, urljoin
+
+
+class PooledResponse:
+    """Wraps an HTTPResponse and hands its connection back to the pool once
+    the body has been fully read."""
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            # an unread body would poison the connection; drop it
+            self._conn.close()
+            self._conn = None
+        self._response.close()
+
+    def _release(self):
+        if self._conn is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._put(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HTTPPool:
+    """Per-host pool of keep-alive HTTP(S) connections.
+
+    `maxsize` bounds the number of idle connections kept per host; busy
+    hosts get extra connections on demand, which are simply closed rather
+    than returned when the pool is already full.  Idle connections older
+    than `idle_timeout` seconds are discarded instead of being reused.
+    """
+    MAX_REDIRECTS = 5
+    # methods safe to send again if the connection drops before we get an
+    # answer; anything else might be acted on twice
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, maxsize=4, idle_timeout=60, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        scheme, netloc = key
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since < self.idle_timeout and not _closed(conn):
+                    return conn, True
+                conn.close()
+        if scheme == 'https':
+            conn = HTTPSConnection(netloc, timeout=self.timeout,
+                                   context=ssl._create_default_https_context())
+        else:
+            conn = HTTPConnection(netloc, timeout=self.timeout)
+        return conn, False
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, since in conns:
+                conn.close()
+
+    def urlopen(self, url, data=None):
+        """Drop-in replacement for urllib's urlopen, accepting either a URL
+        or a Request.  Redirects are followed and HTTP errors raise
+        HTTPError, just like urlopen."""
+        if isinstance(url, Request):
+            req = url
+        else:
+            req = Request(url, data)
+        method = req.get_method()
+        url = req.full_url
+        body = req.data
+        headers = dict(req.header_items())
+        # http.client works it out from the body; a wrong one from the
+        # caller would desync the keep-alive connection
+        headers.pop('Content-length', None)
+        if body is not None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self._send(method, url, body, headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urljoin(url, location)
+                if response.status == 303 or (
+                        response.status in (301, 302) and method == 'POST'):
+                    method, body = 'GET', None
+                    headers.pop('Content-type', None)
+                    headers.pop('Content-length', None)
+                continue
+            break
+
+        if response.status >= 400:
+            # buffer the error body so the connection can go back to the pool
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, io.BytesIO(response.read()))
+        return response
+
+    def _send(self, method, url, body, headers):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            conn, reused = self._get(key)
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (HTTPException, OSError):
+                conn.close()
+                if reused and (not sent or
+                               method in self.IDEMPOTENT_METHODS):
+                    # the server probably closed an idle connection on us
+                    log.debug("retrying on fresh connection to %s" %
+                              parsed.netloc)
+                    continue
+                raise
+            return PooledResponse(self, key, conn, response, url)
+
+
+def _closed(conn):
+    """Whether the server has closed an idle connection: its socket reads
+    as ready, at EOF, when no response is due."""
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class RetryPolicy:
+    """Decides whether and when to retry a failed request: exponential
+    backoff with full jitter, honouring Retry-After up to `cap` seconds.
+
+    Only requests the server can't have acted on are retried for methods
+    other than GET: a 429 or 503 answer, never a dropped connection.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    UNPROCESSED_STATUSES = (429, 503)
+
+    def __init__(self, tries=5, base=0.5, cap=30):
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, error, attempt, method='GET', forever=False):
+        """Seconds to wait before retry number `attempt` (0-based) after
+        `error`, or None to give up."""
+        if not forever and attempt + 1 >= self.tries:
+            return None
+        if isinstance(error, HTTPError):
+            if error.code not in self.RETRY_STATUSES:
+                return None
+            if method != 'GET' and error.code not in \
+                    self.UNPROCESSED_STATUSES:
+                return None
+            retry_after = self._retry_after(error.headers)
+            if retry_after is not None:
+                # a caller can give up on a long wait; the channel can't
+                if retry_after > self.cap and not forever:
+                    return None
+                return min(retry_after, self.cap)
+        elif method != 'GET':
+            return None
+        return random.uniform(0, min(self.cap,
+                                     self.base * 2 ** min(attempt, 16)))
+
+    @staticmethod
+    def _retry_after(headers):
+        value = headers.get('Retry-After') if headers is not None else None
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when.timestamp() - time.time())
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` requests per second on average, with
+    bursts of up to `burst`."""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds to wait before using
+        it; tokens taken ahead of time are paid back first, so callers are
+        served in order."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class HostLimiter:
+    """A TokenBucket per server, shared by every session talking to it."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate,
+                                                           self.burst)
+        return bucket.reserve()
@@ -2,86 +2,156 @@ from __future__ import print_function
 
 import re
 import json
+import time
+import html
 import uuid
-import base64
+import binascii
+import queue
 import codecs
+import asyncio
+import itertools
+import weakref
+import threading
 import logging
-
-log = logging.getLogger(__name__)
+from collections import OrderedDict
 
 try:
+    from http.client import HTTPException
     from urllib.error import HTTPError, URLError
-    from urllib.request import urlopen, Request
+    from urllib.request import Request
     from urllib.parse import urlparse, urlunparse, urlencode, unquote_plus, \
         quote_plus
 except ImportError:
     # for temporary py2/3 compatibility
+    from httplib import HTTPException
     from urllib import urlencode
-    from urllib2 import HTTPError, URLError, urlopen, Request
+    from urllib2 import HTTPError, URLError, Request
     from urlparse import urlparse, urlunparse
     input = raw_input
 
+from lyncbot.transport import HTTPPool, RetryPolicy, TokenBucket
+from lyncbot.aio import AsyncHTTP
+from lyncbot.cache import TTLCache, CoalescingCache
+from lyncbot.contacts import ContactIndex
+from lyncbot.jsonstream import StreamDecoder
+from lyncbot import metrics, trace
+
+log = logging.getLogger(__name__)
+
 utfr = codecs.getreader('utf-8')
 
+# what a failed request can raise: HTTP error statuses, network errors and
+# responses cut short (IncompleteRead, asyncio.IncompleteReadError)
+NETWORK_ERRORS = (URLError, OSError, EOFError, HTTPException)
+
+
+def _post_mode(POST):
+    """Maps the POST argument of a resource call to request data and mode:
+    True posts an empty body, a str posts plain text, anything else JSON."""
+    if POST is True:
+        return '', 'raw'
+    elif isinstance(POST, str):
+        return POST, 'plain'
+    return POST, 'json'
+
+
 ### TERRIBLE MONKEY PATCH TO AVOID SSL CERT ISSUE
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 ###
 
 class DataHref(str):
+    """The content of a data: link, as a str.  The link it came from is
+    kept, so handing it back to the server doesn't re-encode anything."""
+    TAG_RE = re.compile(r'<[^>]*>')
+
     def __new__(cls, content):
         if content.startswith('data:'):
-            content_type, encoding, content = cls._decode(content)
-            new = str.__new__(cls, content)
-            new.content_type = content_type
-            new.encoding = encoding
+            content_type, encoding, decoded = cls._decode(content)
+            new = str.__new__(cls, decoded)
+            new._href = content
         else:
             new = str.__new__(cls, content)
-            new.content_type = 'text/plain'
-            new.encoding = 'charset=utf8'
+            content_type, encoding = 'text/plain', 'charset=utf8'
+            new._href = None
+        new.content_type = content_type
+        new.encoding = encoding
         return new
 
     @classmethod
     def from_str(cls, content, content_type='text/plain',
                  encoding='charset=utf8'):
-        new = cls(content)
+        new = str.__new__(cls, content)
         new.content_type = content_type
         new.encoding = encoding
+        new._href = None
         return new
     
     @staticmethod
     def _decode(orig):
-        assert orig.startswith('data:')
-        content_type, content = orig[5:].split(';', 1)
-        encoding, data = content.split(',', 1)
-        if encoding == 'base64':
-            decoded = base64.b64decode(data)
-        elif encoding.startswith('charset='):
-            # TODO: figure out exactly what's up with python charset handling
-            decoded = unquote_plus(data)
-        else:
-            raise Exception('no support yet for encoding %s' % encoding)
-        return content_type, encoding, decoded
+        header, data = orig[5:].split(',', 1)
+        params = header.split(';')
+        content_type = params[0] or 'text/plain'
+        charset = 'utf-8'
+        for param in params[1:]:
+            if param.startswith('charset='):
+                charset = param[8:]
+        if params[-1] == 'base64':
+            # a2b_base64 reads the ASCII str in place, without first
+            # encoding a copy of it like b64decode would
+            decoded = binascii.a2b_base64(data).decode(charset, 'replace')
+            return content_type, 'base64', decoded
+        if len(params) > 1 and not params[-1].startswith('charset='):
+            raise Exception('no support yet for encoding %s' % params[-1])
+        return content_type, params[-1] if len(params) > 1 else \
+            'charset=' + charset, unquote_plus(data, charset, 'replace')
 
     def __repr__(self):
         return "DataHref(%s)" % repr(self.href())
 
     def plaintext(self):
         if self.content_type == 'text/html':
-            return re.sub('\s+', ' ', re.sub('<[^>]*>', ' ', self)).strip()
+            # str.split collapses the whitespace left by the tags in C
+            text = ' '.join(self.TAG_RE.sub(' ', self).split())
+            return html.unescape(text) if '&' in text else text
         return self
 
     def href(self):
+        if self._href is not None:
+            return self._href
         if self.encoding == 'base64':
-            encoded = base64.b64encode(self.encode('ascii')).decode('ascii')
+            encoded = binascii.b2a_base64(self.encode('utf-8'),
+                                          newline=False).decode('ascii')
+            params = 'charset=utf-8;base64'
         elif self.encoding.startswith('charset='):
             encoded = quote_plus(self)
+            params = self.encoding
         else:
             raise Exception('no support yet for encoding %s' % self.encoding)
-        return "data:%s;%s,%s" % (self.content_type, self.encoding, encoded)
+        self._href = "data:%s;%s,%s" % (self.content_type, params, encoded)
+        return self._href
         
     
+_MISSING = object()
+
+# (user URL, OAuth URL) by domain, shared by every session in the process
+# since all users of a domain normally live on the same pool
+discovery_cache = CoalescingCache(maxsize=64, ttl=3600)
+
+
 class UCWAResource(dict):
+    """A UCWA resource as the dict decoded from its JSON, with its links and
+    embedded resources reachable as attributes.
+
+    Child resources are only built on first attribute access and then
+    memoized, since handlers usually read just a couple of them.  A stub
+    (created from a bare href) fetches itself on first attribute access.
+
+    Use LyncUCWA.resource to get one: it hands out a single shared object
+    per href, so refreshes and events reach everyone holding it.
+    """
+    __slots__ = ('_ucwa', '_stub', '_attrs', '__weakref__')
+
     # some links or properties map to Python reserved words; these are
     # synonyms.
     RESERVED_ALT = {
@@ -92,6 +162,7 @@ class UCWAResource(dict):
     def __init__(self, *args, **kwargs):
         dict.__init__(self)
         self._ucwa = kwargs['ucwa']
+        self._attrs = None
         if 'href' in kwargs:
             self.update({'_links': {'self': {'href': kwargs['href']}}})
             self._stub = True
@@ -106,40 +177,61 @@ class UCWAResource(dict):
 
     def update(self, other):
         dict.update(self, other)
-        for link in self.get('_links', {}):
-            if link == 'self':
-                continue
-            href = self['_links'][link]['href']
-            new_attr = None
+        # children are rebuilt from the new data on next access
+        self._attrs = None
+
+    def replace(self, other):
+        """Swaps in a new version of the resource, in place, without
+        ever leaving it empty for other threads to see."""
+        for key in [k for k in self if k not in other]:
+            del self[key]
+        self.update(other)
+        self._stub = False
+
+    def _materialize(self, name):
+        embedded = dict.get(self, '_embedded')
+        if embedded and name in embedded:
+            value = embedded[name]
+            if isinstance(value, list):
+                return [self._ucwa.resource(data=r) for r in value]
+            return self._ucwa.resource(data=value)
+
+        links = dict.get(self, '_links')
+        if links and name != 'self' and name in links:
+            link = links[name]
+            href = link['href']
             if href.startswith('/'):
-                new_attr = UCWAResource(href=href, ucwa=self._ucwa)
-                for key in self['_links'][link].keys() - set(['href']):
-                    new_attr[key] = self['_links'][link][key]
+                new_attr = self._ucwa.resource(href=href)
+                if new_attr._stub:
+                    for key in link.keys() - set(['href']):
+                        new_attr.setdefault(key, link[key])
+                return new_attr
             elif href.startswith('data:'):
-                new_attr = DataHref(href)
-            if new_attr is not None:
-                setattr(self, link, new_attr)
-                if link in self.RESERVED_ALT:
-                    setattr(self, self.RESERVED_ALT[link], new_attr)
-                
-        for embed in self.get('_embedded', {}):
-            value = self['_embedded'][embed]
-            if isinstance(value, list):
-                setattr(self, embed, [UCWAResource(r, ucwa=self._ucwa)
-                                      for r in value])
-            else:
-                setattr(self, embed, UCWAResource(value, ucwa=self._ucwa))
+                return DataHref(href)
+        return _MISSING
 
     def __getattr__(self, name):
+        if name.startswith('__') or name in UCWAResource.__slots__:
+            raise AttributeError(name)
         if self._stub:
             # we're a stub, refresh before proceeding
-            self.refresh()
+            with trace.stub_refresh():
+                self.refresh()
+        name = self.RESERVED_ALT_REV.get(name, name)
+        # update() may drop the memo from another thread at any point, so
+        # read it once and swap in a new dict rather than mutating it, and
+        # don't bring back one that was dropped while we materialized
+        attrs = self._attrs
+        if attrs is not None and name in attrs:
+            return attrs[name]
+        value = self._materialize(name)
+        if value is not _MISSING:
+            if self._attrs is attrs:
+                self._attrs = dict(attrs or (), **{name: value})
+            return value
         if name in self:
             return self[name]
-        elif name in self.RESERVED_ALT_REV:
-            return self[self.RESERVED_ALT_REV[name]]
-        else:
-            return self.__getattribute__(name)
+        raise AttributeError(name)
                 
     def __call__(self, POST=None, **kwargs):
         return self._get_url(self['_links']['self']['href'], POST=POST,
@@ -150,57 +242,263 @@ class UCWAResource(dict):
         if kwargs:
             url += "?" + urlencode(kwargs)
 
-        mode = 'json'
-        if POST is True:
-            POST = ''
-            mode = 'raw'
-        elif isinstance(POST, str):
-            mode = 'plain'
-        req = urlopen(self._ucwa._request(url, POST, mode))
+        if POST is not None:
+            # whatever we post to has probably changed
+            self._ucwa.cache.pop(self['_links']['self']['href'])
+        POST, mode = _post_mode(POST)
+        req = self._ucwa._open(self._ucwa._request(url, POST, mode))
 
         if req.getheader('Content-Type', '').startswith('application/json'):
-            res = UCWAResource(json.load(utfr(req)), ucwa=self._ucwa)
+            j = json.load(utfr(req))
+            if POST is None:
+                self._ucwa._record(url[len(self._ucwa.appbase):], j)
+            res = self._ucwa.resource(data=j)
             if hasattr(res, 'next'):
-                return UCWAIterator(res)
+                return UCWAIterator(res, self._ucwa.prefetch_depth)
             else:
                 return res
-        elif req.getheader('Location'):
+        # drain the body so the connection can be reused
+        req.read()
+        if req.getheader('Location'):
             return req.getheader('Location')
 
     def refresh(self):
-        ucwa = self._ucwa
-        url = ucwa.appbase + self['_links']['self']['href']
-        req = urlopen(ucwa._request(url))
-        j = json.load(utfr(req))
-        self.clear()
-        self.__init__(j, ucwa=ucwa)
+        self.replace(self._ucwa._fetch(self['_links']['self']['href']))
+
+
+class Prefetcher:
+    """Runs an iterator in a background thread, staying up to `depth`
+    items ahead of whoever consumes it.  Exceptions are re-raised in the
+    consumer; close() tells the producer to stop after its current item."""
+    def __init__(self, iterable, depth=1):
+        self._queue = queue.Queue(max(depth, 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce,
+                                        args=(iterable,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((True, item)):
+                    return
+            self._put((False, None))
+        except Exception as e:
+            self._put((False, e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        ok, item = self._queue.get()
+        if ok:
+            return item
+        self.close()
+        if item is not None:
+            raise item
+        raise StopIteration
+
+    next = __next__
+
+    def close(self):
+        self._stop.set()
 
 
 class UCWAIterator:
-    def __init__(self, initial):
+    """Iterates a paged resource.  Up to `prefetch` following pages are
+    fetched in the background while the current one is being used."""
+    def __init__(self, initial, prefetch=1):
         self.initial = initial
+        self.prefetch = prefetch
 
-    def __iter__(self):
+    def _pages(self):
         cur = self.initial
-        yield self.initial
         while hasattr(cur, 'next'):
             cur = cur.next
             cur.refresh()
             yield cur
+
+    def __iter__(self):
+        if not self.prefetch:
+            yield self.initial
+            for page in self._pages():
+                yield page
+            return
+        pages = Prefetcher(self._pages(), self.prefetch)
+        try:
+            yield self.initial
+            for page in pages:
+                yield page
+        finally:
+            # the consumer stopped early, or we ran out
+            pages.close()
         
 
+class OutboxFull(Exception):
+    pass
+
+
 class UCWAConversation:
+    # most messages waiting in the outbox before queue_message blocks
+    OUTBOX_SIZE = 50
+    # seconds to wait for our invitation to be accepted before sending
+    # follow-up messages anyway
+    INVITE_TIMEOUT = 30
+    # seconds an idle outbox worker lingers before exiting
+    WORKER_IDLE = 5
+
     def __init__(self, ucwa, other):
         self.ucwa = ucwa
         self.other = other
         self.conversation = None
         self.inbound_callback = None
         self.invite_message = None
-        self.ucwa.register_callback(self._inbound_message, 'conversation',
-                                    link_rel='message')
+        self._send_lock = None
+        self._outbox = queue.Queue(self.OUTBOX_SIZE)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._invite_href = None
+        self._invited = threading.Event()
+        # asyncio counterpart of _invited, for asend, and its loop
+        self._ainvited = None
+        self._loop = None
+
+    def queue_message(self, message, callback=None, timeout=None):
+        """Queues a message to be sent in order in the background, so the
+        caller doesn't wait on the network.  The outbox is drained by a
+        task on the session's EventMultiplexer loop, or by a worker thread
+        if nothing is listening to it.  If the outbox is full, this blocks
+        for up to `timeout` seconds and then raises OutboxFull.
+        `callback(message, error)` is called once the message has been
+        delivered (error is None) or has failed."""
+        try:
+            # the send is traced under whatever queued the message
+            span = trace.current()
+            self._outbox.put((message, callback,
+                              span.id if span is not None else None),
+                             timeout=timeout)
+        except queue.Full:
+            raise OutboxFull("outbox to %s is full" % ", ".join(self.other))
+        with self._worker_lock:
+            if self._worker is not None:
+                return
+            loop = self.ucwa.event_loop
+            if loop is not None:
+                self._worker = asyncio.run_coroutine_threadsafe(
+                    self._adrain_outbox(), loop)
+            else:
+                self._worker = threading.Thread(target=self._drain_outbox)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def outbox_depth(self):
+        return self._outbox.qsize()
+
+    def _drain_outbox(self):
+        idle = False
+        try:
+            while True:
+                try:
+                    message, callback, parent = self._outbox.get(
+                        timeout=self.WORKER_IDLE)
+                except queue.Empty:
+                    with self._worker_lock:
+                        if self._outbox.empty():
+                            self._worker = None
+                            idle = True
+                            return
+                    continue
+                error = None
+                try:
+                    if self.ucwa.tracer is None:
+                        self.send(message)
+                    else:
+                        with self.ucwa.tracer.span('send', parent=parent,
+                                                   to=self.other):
+                            self.send(message)
+                except Exception as e:
+                    log.exception("failed to send message to %s" %
+                                  ", ".join(self.other))
+                    error = e
+                if callback is not None:
+                    self._deliver(callback, message, error)
+        finally:
+            if not idle:
+                # we died; let the next queue_message start another worker
+                with self._worker_lock:
+                    self._worker = None
+
+    async def _adrain_outbox(self):
+        loop = asyncio.get_event_loop()
+        idle = False
+        try:
+            while True:
+                with self._worker_lock:
+                    try:
+                        message, callback, parent = \
+                            self._outbox.get_nowait()
+                    except queue.Empty:
+                        self._worker = None
+                        idle = True
+                        return
+                error = None
+                try:
+                    if self.ucwa.tracer is None:
+                        await self.asend(message)
+                    else:
+                        with self.ucwa.tracer.span('send', parent=parent,
+                                                   to=self.other):
+                            await self.asend(message)
+                except Exception as e:
+                    log.exception("failed to send message to %s" %
+                                  ", ".join(self.other))
+                    error = e
+                if callback is not None:
+                    # callbacks may block; keep them off the loop
+                    await loop.run_in_executor(None, self._deliver, callback,
+                                               message, error)
+        finally:
+            if not idle:
+                with self._worker_lock:
+                    self._worker = None
+
+    def _deliver(self, callback, message, error):
+        try:
+            callback(message, error)
+        except Exception:
+            log.exception("delivery callback for message to %s failed" %
+                          ", ".join(self.other))
+
+    def _invitation_completed(self):
+        self._invited.set()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ainvited.set)
+
+    def _invitation_sent(self, href):
+        self._invite_href = href
+        if self.ucwa.await_invitation(href, self):
+            self._invitation_completed()
+
+    def _invitation_waited(self):
+        self.ucwa.forget_invitation(self._invite_href)
+        self._invite_href = None
 
     def send(self, message):
         if self.conversation is not None:
+            if self._invite_href is not None:
+                # messages sent before the invitation is accepted get lost
+                self._invited.wait(self.INVITE_TIMEOUT)
+                self._invitation_waited()
             self.conversation.messaging.sendMessage(POST=message)
         else:
             loc = self.ucwa.application.communication.startMessaging(POST={
@@ -214,52 +512,222 @@ class UCWAConversation:
             })
             if not loc:
                 raise Exception("failed to send messagingInvitation")
-            invite = UCWAResource(href=loc, ucwa=self.ucwa)
-            self.conversation = invite.conversation
+            self._invitation_sent(loc)
+            invite = self.ucwa.resource(href=loc)
+            self.attach(invite)
             # TODO: if len(other) > 1, invite others
 
+    async def asend(self, message):
+        """Same as send, but without blocking the event loop."""
+        # keep concurrent sends in order, and from starting two invitations
+        if self._send_lock is None:
+            self._send_lock = asyncio.Lock()
+        async with self._send_lock:
+            await self._asend(message)
+
+    async def _asend(self, message):
+        ucwa = self.ucwa
+        if self.conversation is not None:
+            if self._invite_href is not None:
+                # messages sent before the invitation is accepted get lost
+                try:
+                    await asyncio.wait_for(self._ainvited.wait(),
+                                           self.INVITE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                self._invitation_waited()
+            if self.conversation._stub:
+                await ucwa.arefresh(self.conversation)
+            messaging = self.conversation.messaging
+            if messaging._stub:
+                await ucwa.arefresh(messaging)
+            await ucwa.aget(messaging['_links']['sendMessage']['href'],
+                            POST=message)
+        else:
+            self._loop = asyncio.get_event_loop()
+            self._ainvited = asyncio.Event()
+            communication = ucwa.application.communication
+            loc = await ucwa.aget(
+                communication['_links']['startMessaging']['href'], POST={
+                    "operationId": "%x" % abs(hash(self)),
+                    "to": "sip:" + self.other[0],
+                    "_links": {
+                        "message": {
+                            "href": DataHref.from_str(message).href()
+                        }
+                    }
+                })
+            if not loc:
+                raise Exception("failed to send messagingInvitation")
+            self._invitation_sent(loc)
+            invite = await ucwa.aget(loc)
+            self.attach(invite)
+
     def set_inbound_callback(self, cb):
         self.inbound_callback = cb
 
-    def _inbound_message(self, u, event):
-        # skip messages not for this conversation
-        if event.message.direction != 'Incoming':
-            return
-        if self.conversation is None:
-            return
-        if event.message.messaging != self.conversation.messaging:
-            return
+    def attach(self, invitation):
+        """Ties us to the conversation of a messagingInvitation, so its
+        inbound messages get routed to us."""
+        self.conversation = invitation.conversation
+        links = invitation['_links']
+        if 'messaging' in links:
+            messaging = links['messaging']['href']
+        else:
+            messaging = self.conversation.messaging['_links']['self']['href']
+        self.ucwa.route_messages(messaging, self)
+
+    def close(self):
+        if self._invite_href is not None:
+            self._invitation_waited()
+        self.ucwa.unroute_messages(self)
+
+    def _inbound_message(self, message):
         if self.inbound_callback is None:
             return
-        
-        try:
-            sender = event.message.participant.title.split()[0]
-        except AttributeError:
-            sender = event.message.contact.name.split()[0]
-        try:
-            ev_message = event.message.htmlMessage.plaintext()
-        except AttributeError:
-            ev_message = event.message.plainMessage
+        # read the links directly; going through attributes would fetch
+        # the participant just for its title
+        links = message['_links']
+        title = links.get('participant', {}).get('title')
+        if title:
+            sender = title.split()[0]
+        else:
+            sender = self.ucwa.resource(data=message).contact.name \
+                .split()[0]
+        if 'htmlMessage' in links:
+            ev_message = DataHref(links['htmlMessage']['href']).plaintext()
+        else:
+            ev_message = DataHref(links['plainMessage']['href'])
         message = "%s: %s" % (sender, ev_message)
         self.inbound_callback(message)
 
 
 class LyncUCWA:
-    def __init__(self, username, password):
+    # never cache these; every events href is only fetched once anyway
+    UNCACHED_RE = re.compile(r'/events\b')
+    # most resources fetched in one batch request
+    BATCH_LIMIT = 100
+    # how long presence subscriptions last, in minutes
+    PRESENCE_DURATION = 30
+    # seconds normalize_contact remembers a name it resolved, and a name
+    # it couldn't resolve to exactly one contact
+    NAME_TTL = 600
+    NAME_MISS_TTL = 60
+    # autodiscovery URL for a domain; override to use a test server
+    DISCOVER_URL = "https://lyncdiscover.%s/"
+    # events remembered so replays after a reconnect are dropped, and
+    # seconds between saves of the event channel's cursor; every save
+    # rewrites the whole session store
+    SEEN_EVENTS = 256
+    CURSOR_SAVE_INTERVAL = 10
+    # completed invitations remembered for a sender yet to wait on them
+    SEEN_INVITATIONS = 64
+
+    def __init__(self, username, password=None, transport=None,
+                 async_transport=None, cache_size=1024, cache_ttl=60,
+                 session_store=None, prefetch_depth=1, rate_limit=None,
+                 host_limiter=None, retry_policy=None, tracer=None,
+                 recorder=None):
+        self.username = username
+        # optional trace.Tracer; events are traced in spans of their own
+        self.tracer = tracer
+        # optional recorder.Recorder of event pages and resources fetched
+        self.recorder = recorder
+        # pages fetched ahead while iterating paged resources, like events
+        self.prefetch_depth = prefetch_depth
         self.auth_headers = None
+        self.auth_expires = None
+        self.auth_url = None
+        # kept to get a new token when ours expires
+        self._password = password
+        self._auth_lock = threading.Lock()
+        # optional SessionStore to resume from and save to
+        self.session_store = session_store
+        self._events_received = metrics.EVENTS_RECEIVED.labels(username)
+        self._events_dispatched = metrics.EVENTS_DISPATCHED.labels(username)
+        self._callback_duration = metrics.CALLBACK_DURATION.labels(username)
         self.callbacks = {}
+        self._dispatch_table = {}
+        self._callback_lock = threading.Lock()
+        # keep-alive connection pool shared by every request of this
+        # session; pass one in to share it between sessions
+        self.transport = transport if transport is not None else HTTPPool()
+        # asyncio counterpart used by the a* methods, created on first use
+        # unless an EventMultiplexer hands us its own
+        self.async_transport = async_transport
+        # loop of the EventMultiplexer listening to us, if any; outboxes
+        # are drained on it
+        self.event_loop = None
+        # requests per second allowed for this session, and a HostLimiter
+        # shared with the other sessions on the same server
+        self.rate_limit = TokenBucket(rate_limit) if rate_limit else None
+        self.host_limiter = host_limiter
+        self.retry_policy = retry_policy if retry_policy is not None \
+            else RetryPolicy()
+        # the one live UCWAResource per href, for as long as anyone holds it
+        self._resources = weakref.WeakValueDictionary()
+        self._resources_lock = threading.Lock()
+        # resource JSON by href, with ETags for conditional GETs
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._contact_index = None
+        self._contact_lock = threading.Lock()
+        # open conversations by the href of their messaging resource
+        self._conversations = {}
+        self._conversations_lock = threading.Lock()
+        # conversations waiting on their messagingInvitation by its href,
+        # and invitations that completed before anyone waited on them
+        self._invitations = {}
+        self._invitations_done = OrderedDict()
+        # normalize_contact results by normalized name
+        self._names = TTLCache(256, self.NAME_TTL)
+        # availability by contactPresence href, kept current from presence
+        # events while our subscription lasts
+        self._presence = {}
+        self._presence_expires = 0
+        self._presence_lock = threading.Lock()
+        # where the event channel left off, kept in the session store if
+        # there is one, and the (page href, index) of events handled lately
+        self.event_href = None
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self._cursor_saved = None
+        self._cursor_saved_at = 0
+
+        # keep the contact index current
+        self.register_callback(self._contact_event, 'people',
+                               link_rel='contact')
+        self.register_callback(self._contact_event, 'people',
+                               link_rel='myContacts')
+        self.register_callback(self._presence_event, 'people',
+                               link_rel='contactPresence')
+        # hand inbound messages to their conversation
+        self.register_callback(self._message_event, 'conversation',
+                               link_rel='message')
+        self.register_callback(self._invitation_event, 'communication',
+                               link_rel='messagingInvitation',
+                               ev_type='completed')
+
+        if session_store is not None:
+            session = session_store.get(username)
+            if session is not None and self.resume(session):
+                return
+        if password is None:
+            raise Exception("no live session for %s, need a password" %
+                            username)
         
-        # Look up discovery URL and user URL
-        domain = username[username.find('@')+1:]
-        discover_url = "https://lyncdiscover.%s/" % domain
+        # Look up user URL and oauth URL, unless another session already
+        # did for this domain
+        self.domain = username[username.find('@')+1:]
+        discovered = discovery_cache.get_or_load(self.domain, self._discover)
+        self.user_url, self.auth_url = discovered
         try:
-            discover_json = json.load(utfr(urlopen(discover_url)))
-        except URLError:
-            raise Exception("could not contact discovery url %s" %
-                            discover_url)
-        self.user_url = discover_json['_links']['user']['href']
-
-        self.login(username, password)
+            self.login(username, password)
+        except Exception:
+            # perhaps the pool moved; discover again next time
+            discovery_cache.pop(self.domain)
+            raise
+        if self.user_url != discovered[0]:
+            discovery_cache.set(self.domain, (self.user_url, self.auth_url))
 
     def _request(self, url, data=None, mode='json'):
         headers = self.auth_headers.copy()
@@ -267,56 +735,365 @@ class LyncUCWA:
             if mode == 'json':
                 data = json.dumps(data)
                 headers['Content-Type'] = 'application/json'
-                headers['Content-Length'] = len(data)
             elif mode == 'urlenc':
                 data = urlencode(data)
             elif mode == 'html':
                 headers['Content-Type'] = 'text/html'
-                headers['Content-Length'] = len(data)
             elif mode == 'plain':
                 headers['Content-Type'] = 'text/plain'
-                headers['Content-Length'] = len(data)
             data = bytes(data, 'utf-8')
+            # of the encoded body; non-ASCII text is longer in bytes
+            headers['Content-Length'] = len(data)
         return Request(url, data, headers=headers)
-        
-    def login(self, username, password):
-        # Ping the user URL, expecting a 401 and address of oauth server
+
+    def _throttle(self, url):
+        """Seconds to wait before sending a request to `url`."""
+        delay = 0
+        if self.rate_limit is not None:
+            delay = self.rate_limit.reserve()
+        if self.host_limiter is not None:
+            delay = max(delay, self.host_limiter.reserve(url))
+        return delay
+
+    def _retry_delay(self, req, error, attempt):
+        delay = self.retry_policy.delay(error, attempt, req.get_method())
+        if delay is not None:
+            log.warning("%s %s failed (%s), retrying in %.1fs" %
+                        (req.get_method(), req.full_url, error, delay))
+        return delay
+
+    def _open(self, req):
+        if not isinstance(req, Request):
+            req = Request(req)
         try:
-            user_response = urlopen(self.user_url)
-        except HTTPError as error_response:
-            wwwauth_header = str(error_response.info())
-        auth_url_re = re.search('MsRtcOAuth href="([^"]*)"', wwwauth_header)
+            return self._send(req)
+        except HTTPError as error:
+            if not self._token_expired(req, error):
+                raise
+        self._reauthenticate(req.get_header('Authorization'))
+        req.add_header('Authorization', self.auth_headers['Authorization'])
+        return self._send(req)
+
+    async def _aopen(self, req):
         try:
-            auth_url = auth_url_re.group(1)
-        except AttributeError:
-            raise AttributeError("missing auth_url in %s" % repr(wwwauth_header))
+            return await self._asend(req)
+        except HTTPError as error:
+            if not self._token_expired(req, error):
+                raise
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._reauthenticate, req.get_header('Authorization'))
+        req.add_header('Authorization', self.auth_headers['Authorization'])
+        return await self._asend(req)
 
-        # verify domain
-        user_url_parse = urlparse(self.user_url)
-        auth_url_parse = urlparse(auth_url)
-        if user_url_parse[1] != auth_url_parse[1]:
-            self.user_url = urlunparse(
-                [user_url_parse[0], auth_url_parse[1]] + list(user_url_parse[2:])
-                )
-            self.login(username, password)
+    def _send(self, req):
+        for attempt in itertools.count():
+            time.sleep(self._throttle(req.full_url))
+            start = time.time()
+            try:
+                res = self.transport.urlopen(req)
+                self._observe(req, start, res=res)
+                return res
+            except NETWORK_ERRORS as error:
+                self._observe(req, start, error)
+                delay = self._retry_delay(req, error, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
 
-        # Send auth request
+    async def _asend(self, req):
+        if self.async_transport is None:
+            self.async_transport = AsyncHTTP()
+        for attempt in itertools.count():
+            await asyncio.sleep(self._throttle(req.full_url))
+            start = time.time()
+            try:
+                res = await self.async_transport.request(
+                    req.get_method(), req.full_url, req.data,
+                    dict(req.header_items()))
+                self._observe(req, start, res=res)
+                return res
+            except NETWORK_ERRORS as error:
+                self._observe(req, start, error)
+                delay = self._retry_delay(req, error, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    def _observe(self, req, start, error=None, res=None):
+        duration = time.time() - start
+        resource = metrics.resource_type(req.full_url)
+        metrics.HTTP_DURATION.labels(
+            self.username, resource, req.get_method()).observe(duration)
+        if error is not None:
+            status = getattr(error, 'code', 0)
+            metrics.HTTP_ERRORS.labels(self.username, resource, status).inc()
+            nbytes = None
+        else:
+            status = res.status
+            nbytes = res.getheader('Content-Length')
+        trace.record(req.get_method(), req.full_url, status,
+                     int(nbytes) if nbytes else None, duration)
+
+    def _token_expired(self, req, error):
+        return error.code == 401 and req.has_header('Authorization') and \
+            self._password is not None and self.auth_url is not None
+
+    def _reauthenticate(self, stale):
+        """Replaces the expired token `stale` with a new one.  The
+        application and everything hanging off it stay as they are."""
+        with self._auth_lock:
+            if self.auth_headers['Authorization'] != stale:
+                # another request already got a new token
+                return
+            log.info("token for %s expired, getting a new one" %
+                     self.username)
+            self._authenticate(self._password)
+            if self.session_store is not None:
+                self.session_store.update(self.username,
+                                          auth_headers=self.auth_headers,
+                                          expires=self.auth_expires)
+
+    def _authenticate(self, password):
+        """Gets an OAuth token with the password grant and sets up our
+        auth headers with it."""
         auth_data = {
             'grant_type': 'password',
-            'username': username,
+            'username': self.username,
             'password': password
             }
-        auth_request = urlopen(auth_url, data=bytes(urlencode(auth_data),
-                                                    'utf-8'))
+        auth_request = self._open(Request(self.auth_url,
+                                          bytes(urlencode(auth_data), 'utf-8')))
         access_token = json.load(utfr(auth_request))
-
-        # Resend user request with oauth headers, get applications url
+        self.auth_expires = time.time() + int(access_token.get('expires_in',
+                                                               3600))
         self.auth_headers = {
             'Authorization':" ".join((access_token['token_type'],
                                       access_token['access_token'])),
             'Content-Type': 'application/json'
             }
-        app_request = urlopen(self._request(self.user_url))
+
+    def _channel_delay(self, error, failures):
+        """Backoff before polling the event channel again after a failure,
+        or None if it is not worth retrying.  Transient errors are retried
+        for as long as they last, so the channel never quietly dies."""
+        delay = self.retry_policy.delay(error, failures, forever=True)
+        if delay is not None:
+            log.warning("event channel failed (%s), retrying in %.1fs" %
+                        (error, delay))
+        return delay
+
+    async def aget(self, href, POST=None, **kwargs):
+        """Async version of calling a resource: GETs `href`, or POSTs to
+        it when POST is given, and returns the resulting UCWAResource or
+        the Location of a created one."""
+        url = self.appbase + href
+        if kwargs:
+            url += "?" + urlencode(kwargs)
+        if POST is not None:
+            self.cache.pop(href)
+        POST, mode = _post_mode(POST)
+        res = await self._aopen(self._request(url, POST, mode))
+        if res.getheader('Content-Type', '').startswith('application/json'):
+            j = json.loads(res.body.decode('utf-8'))
+            if POST is None:
+                self._record(url[len(self.appbase):], j)
+            return self.resource(data=j)
+        return res.getheader('Location')
+
+    def resource(self, href=None, data=None):
+        """The UCWAResource for `href`, or for the JSON `data` of a
+        resource.  Everyone asking for the same href in this session gets
+        the same object; new data is applied to it rather than to a copy."""
+        if data is not None:
+            try:
+                href = data['_links']['self']['href']
+            except KeyError:
+                # not addressable, e.g. an event
+                return UCWAResource(data, ucwa=self)
+        with self._resources_lock:
+            resource = self._resources.get(href)
+            if resource is None:
+                if data is not None:
+                    resource = UCWAResource(data, ucwa=self)
+                else:
+                    resource = UCWAResource(href=href, ucwa=self)
+                self._resources[href] = resource
+                return resource
+        if data is not None and data is not resource:
+            resource.replace(data)
+        return resource
+
+    def _apply_event(self, ev):
+        """Brings the shared resource an event is about up to date."""
+        href = ev['link']['href']
+        with self._resources_lock:
+            resource = self._resources.get(href)
+            if resource is not None and ev['type'] == 'deleted':
+                del self._resources[href]
+        if resource is None or ev['type'] == 'deleted':
+            return
+        embedded = ev.get('_embedded', {}).get(ev['link']['rel'])
+        if embedded is not None:
+            resource.replace(embedded)
+        else:
+            # fetched again on next attribute access
+            resource._stub = True
+
+    def _fetch(self, href):
+        """GETs the JSON of a resource, going through the resource cache.
+        Stale entries are revalidated with If-None-Match when the server
+        gave us an ETag."""
+        cached, fresh = self.cache.lookup(href)
+        if fresh:
+            return cached[1]
+        req = self._request(self.appbase + href)
+        if cached is not None and cached[0]:
+            req.add_header('If-None-Match', cached[0])
+        res = self._open(req)
+        if res.status == 304:
+            res.read()
+            j = cached[1]
+        else:
+            j = json.load(utfr(res))
+        self._cache_store(href, res.getheader('ETag'), j)
+        self._record(href, j)
+        return j
+
+    def _cache_store(self, href, etag, j):
+        if not self.UNCACHED_RE.search(href):
+            self.cache.set(href, (etag, j))
+
+    def _record(self, href, j):
+        if self.recorder is not None:
+            self.recorder.get(self, href, j)
+
+    def batch(self, hrefs):
+        """GETs many resources through UCWA's batch endpoint, one request
+        per BATCH_LIMIT hrefs.  Returns their JSON in the same order, with
+        None for any that failed."""
+        batch_url = self.appbase + self.application['_links']['batch']['href']
+        host = urlparse(self.appbase).netloc
+        results = []
+        for i in range(0, len(hrefs), self.BATCH_LIMIT):
+            boundary = uuid.uuid4().hex
+            body = ''.join(
+                '--%s\r\nContent-Type: application/http; msgtype=request\r\n'
+                '\r\nGET %s HTTP/1.1\r\nHost: %s\r\nAccept: application/json'
+                '\r\n\r\n' % (boundary, href, host)
+                for href in hrefs[i:i + self.BATCH_LIMIT])
+            body += '--%s--\r\n' % boundary
+            req = self._request(batch_url, body, mode='plain')
+            req.add_header('Content-Type',
+                           'multipart/batching;boundary=%s' % boundary)
+            res = self._open(req)
+            ctype = res.getheader('Content-Type', '')
+            payload = res.read().decode('utf-8')
+            results.extend(self._parse_batch(
+                payload, ctype.split('boundary=', 1)[-1].strip('"')))
+        return results
+
+    @staticmethod
+    def _parse_batch(payload, boundary):
+        results = []
+        for part in payload.split('--' + boundary)[1:]:
+            if part.startswith('--'):
+                break
+            # skip the part's own headers, then split the HTTP response
+            response = part.split('\r\n\r\n', 1)[-1]
+            head, _, body = response.partition('\r\n\r\n')
+            status = int(head.split(None, 2)[1])
+            if status == 200 and body.strip():
+                results.append(json.loads(body))
+            else:
+                results.append(None)
+        return results
+
+    def hydrate(self, resources):
+        """Fills in the given stub resources, from the cache where possible
+        and with batch requests for the rest.  Stubs that can't be fetched
+        are left alone, to refresh themselves on access as usual."""
+        pending = []
+        for resource in resources:
+            if not resource._stub:
+                continue
+            cached = self.cache.get(resource['_links']['self']['href'])
+            if cached is not None:
+                resource.replace(cached[1])
+            else:
+                pending.append(resource)
+        hrefs = [r['_links']['self']['href'] for r in pending]
+        for resource, href, j in zip(pending, hrefs, self.batch(hrefs)):
+            if j is None:
+                continue
+            self._cache_store(href, None, j)
+            self._record(href, j)
+            resource.replace(j)
+
+    async def arefresh(self, resource):
+        """Async version of UCWAResource.refresh."""
+        href = resource['_links']['self']['href']
+        cached, fresh = self.cache.lookup(href)
+        if fresh:
+            j = cached[1]
+        else:
+            req = self._request(self.appbase + href)
+            if cached is not None and cached[0]:
+                req.add_header('If-None-Match', cached[0])
+            res = await self._aopen(req)
+            if res.status == 304:
+                j = cached[1]
+            else:
+                j = json.loads(res.body.decode('utf-8'))
+            self._cache_store(href, res.getheader('ETag'), j)
+            self._record(href, j)
+        resource.replace(j)
+        return resource
+        
+    def _discover(self):
+        """Returns the user URL and oauth URL for our domain."""
+        discover_url = self.DISCOVER_URL % self.domain
+        try:
+            discover_json = json.load(utfr(self._open(discover_url)))
+        except NETWORK_ERRORS:
+            raise Exception("could not contact discovery url %s" %
+                            discover_url)
+        user_url = discover_json['_links']['user']['href']
+
+        for _ in range(3):
+            # Ping the user URL, expecting a 401 and address of oauth server
+            wwwauth_header = ''
+            try:
+                self._open(user_url).read()
+            except HTTPError as error_response:
+                wwwauth_header = str(error_response.info())
+            auth_url_re = re.search('MsRtcOAuth href="([^"]*)"',
+                                    wwwauth_header)
+            try:
+                auth_url = auth_url_re.group(1)
+            except AttributeError:
+                raise AttributeError("missing auth_url in %s" %
+                                     repr(wwwauth_header))
+
+            # verify domain
+            user_url_parse = urlparse(user_url)
+            auth_url_parse = urlparse(auth_url)
+            if user_url_parse[1] == auth_url_parse[1]:
+                return user_url, auth_url
+            user_url = urlunparse(
+                [user_url_parse[0], auth_url_parse[1]] + list(user_url_parse[2:])
+                )
+        raise Exception("user url and auth url of %s never agreed on a host" %
+                        self.domain)
+
+    def login(self, username, password):
+        user_url_parse = urlparse(self.user_url)
+
+        # Send auth request
+        self._password = password
+        self._authenticate(password)
+
+        # Resend user request with oauth headers, get applications url
+        app_request = self._open(self._request(self.user_url))
         app_url = json.load(utfr(app_request))['_links']['applications']['href']
         app_data = {
             'culture': 'en-US',
@@ -330,29 +1107,153 @@ class LyncUCWA:
             self.user_url = urlunparse(
                 [user_url_parse[0], app_url_parse[1]] + list(user_url_parse[2:])
                 )
-            self.login(username, password)
+            return self.login(username, password)
 
-        self.application_json = json.load(utfr(urlopen(
+        self.application_json = json.load(utfr(self._open(
             self._request(app_url, app_data))))
         self.appbase = urlunparse(
             urlparse(app_url)[:2] + ('',) * 4)
-        self.application = UCWAResource(self.application_json, ucwa=self)
+        self.application = self.resource(data=self.application_json)
+        # a new application has an event channel of its own
+        self.event_href = None
+        self._seen.clear()
+        self.save_session()
+        if self.recorder is not None:
+            self.recorder.session(self)
+
+    def save_session(self):
+        if self.session_store is None:
+            return
+        self.session_store.put(self.username, {
+            'auth_headers': self.auth_headers,
+            'expires': self.auth_expires,
+            'user_url': self.user_url,
+            'auth_url': self.auth_url,
+            'appbase': self.appbase,
+            'application': self.application['_links']['self']['href'],
+        })
+
+    def resume(self, session):
+        """Picks up a stored application with a single GET, returning
+        False if the token has expired or the application is gone."""
+        # leave a margin so we don't resume a token about to run out
+        if session['expires'] < time.time() + 300:
+            return False
+        self.auth_headers = session['auth_headers']
+        self.auth_expires = session['expires']
+        self.user_url = session['user_url']
+        self.auth_url = session.get('auth_url')
+        self.appbase = session['appbase']
+        try:
+            res = self._open(self._request(self.appbase +
+                                           session['application']))
+            self.application_json = json.load(utfr(res))
+        except NETWORK_ERRORS + (ValueError,):
+            log.info("stored session for %s is gone" % self.username)
+            self.auth_headers = None
+            return False
+        self.application = self.resource(data=self.application_json)
+        self.event_href = self._cursor_saved = session.get('events')
+        if self.recorder is not None:
+            self.recorder.session(self)
+        return True
         
+    def _stream_items(self, href, path, **kwargs):
+        """GETs `href` and yields a UCWAResource for each item at `path` of
+        the response (see jsonstream.StreamDecoder) as it is decoded,
+        without holding the whole response in memory."""
+        url = self.appbase + href
+        if kwargs:
+            url += "?" + urlencode(kwargs)
+        res = self._open(self._request(url))
+        for contexts, item in StreamDecoder(res).iter_path(path):
+            yield self.resource(data=item)
+
     def search(self, query):
-        return self.application.people.search(query=query).contact
+        return self._stream_items(
+            self.application.people['_links']['search']['href'],
+            ('_embedded', 'contact', '*'), query=query)
 
     def contacts(self, query=None):
         # TODO: add groups support?
-        all_contacts = self.application.people.myContacts.contact
+        index = self.contact_index()
         if query is not None:
             if '@' in query:
-                return [c for c in all_contacts if query in c.emailAddresses]
+                return index.email(query)
             else:
-                return [c for c in all_contacts
-                        if c.name.lower().startswith(query.lower())]
+                return index.prefix(query)
         else:
-            return all_contacts
+            return list(index)
+
+    def contact_summaries(self, query=None):
+        """(availability, name, email) of the contacts matching `query`,
+        as plain data that can be handed to another process."""
+        return [(self.availability(c), c.name, c.emailAddresses[0])
+                for c in self.contacts(query)]
+
+    def contact_index(self):
+        """The ContactIndex over myContacts, downloaded once per session and
+        then kept up to date from contact events."""
+        with self._contact_lock:
+            if self._contact_index is None:
+                self._contact_index = ContactIndex(self._stream_items(
+                    self.application.people['_links']['myContacts']['href'],
+                    ('_embedded', 'contact', '*')))
+            return self._contact_index
+
+    def _contact_event(self, u, event):
+        # names may now resolve differently
+        self._names.clear()
+        if self._contact_index is None:
+            return
+        if event['link']['rel'] == 'myContacts':
+            # the whole list changed under us; rebuild on next use
+            with self._contact_lock:
+                self._contact_index = None
+        elif event['type'] == 'deleted':
+            self._contact_index.remove(event['link']['href'])
+        elif 'contact' in event.get('_embedded', {}):
+            self._contact_index.add(event.contact)
+        else:
+            self._contact_index.add(
+                self.resource(data=self._fetch(event['link']['href'])))
     
+    def availability(self, contact):
+        """The availability of a contact.  Contacts in our contact list are
+        answered from the presence table; anyone else is looked up."""
+        self._subscribe_presence()
+        href = contact['_links']['contactPresence']['href']
+        try:
+            return self._presence[href]
+        except KeyError:
+            return contact.contactPresence.availability
+
+    def _subscribe_presence(self):
+        """Subscribes to the presence of the whole contact list and fills
+        the presence table, unless a subscription is still running."""
+        with self._presence_lock:
+            if self._presence_expires > time.time():
+                return
+            contacts = self.contacts()
+            presences = [c.contactPresence for c in contacts]
+            if contacts:
+                self.application.people.presenceSubscriptions(POST={
+                    'duration': self.PRESENCE_DURATION,
+                    'uris': [c['uri'] for c in contacts],
+                })
+                self.hydrate(presences)
+            self._presence = dict(
+                (p['_links']['self']['href'], p['availability'])
+                for p in presences if 'availability' in p)
+            # renew a minute early so we never miss an update
+            self._presence_expires = time.time() + \
+                self.PRESENCE_DURATION * 60 - 60
+
+    def _presence_event(self, u, event):
+        href = event['link']['href']
+        if href in self._presence:
+            self._presence[href] = self._fetch(href).get('availability')
+
     def set_available(self, avail=True):
         request_body = {
             'signInAs': 'Online' if avail else 'Away',
@@ -371,13 +1272,18 @@ class LyncUCWA:
     def normalize_contact(self, name):
         if isinstance(name, list):
             name = " ".join(name)
-        # TODO: check if name matches email regex, if so, return directly
-        hits = self.contacts(name)
-        if not hits:
-            hits = list(self.search(name))
+        key = " ".join(name.lower().split())
+        hits = self._names.get(key)
+        if hits is None:
+            # TODO: check if name matches email regex, if so, return directly
+            hits = self.contacts(name)
+            if not hits:
+                hits = list(self.search(name))
+            hits = [h.emailAddresses[0] for h in hits]
+            self._names.set(key, hits, None if len(hits) == 1 else
+                            self.NAME_MISS_TTL)
         if not hits:
             raise Exception("couldn't find %s" % name)
-        hits = [h.emailAddresses[0] for h in hits]
         if len(hits) != 1:
             raise Exception("the name %s was ambiguous - found %s" %
                             (name, ", ".join(hits)))
@@ -395,7 +1301,7 @@ class LyncUCWA:
             other = event.messagingInvitation.frm.uri.split(':')[1]
             event.messagingInvitation.accept(POST=True)
             conversation = UCWAConversation(u, [other])
-            conversation.conversation = event.messagingInvitation.conversation
+            conversation.attach(event.messagingInvitation)
             conversation.invite_message = event.messagingInvitation.message
             cb(conversation)
 
@@ -403,31 +1309,291 @@ class LyncUCWA:
                                link_rel='messagingInvitation',
                                ev_type='started')
 
-    def register_callback(self, callback, rel, link_rel=None, ev_type=None):
+    def route_messages(self, messaging_href, conversation):
+        with self._conversations_lock:
+            self._conversations[messaging_href] = conversation
+
+    def unroute_messages(self, conversation):
+        with self._conversations_lock:
+            for href, c in list(self._conversations.items()):
+                if c is conversation:
+                    del self._conversations[href]
+
+    def await_invitation(self, href, conversation):
+        """Has `conversation` told when the messagingInvitation at `href`
+        completes.  Returns True if it already has."""
+        with self._conversations_lock:
+            if self._invitations_done.pop(href, None):
+                return True
+            self._invitations[href] = conversation
+            return False
+
+    def forget_invitation(self, href):
+        with self._conversations_lock:
+            self._invitations.pop(href, None)
+
+    def _invitation_event(self, u, event):
+        href = event['link']['href']
+        with self._conversations_lock:
+            conversation = self._invitations.pop(href, None)
+            if conversation is None:
+                # the event can beat startMessaging's response to us
+                self._invitations_done[href] = True
+                while len(self._invitations_done) > self.SEEN_INVITATIONS:
+                    self._invitations_done.popitem(last=False)
+        if conversation is not None:
+            conversation._invitation_completed()
+
+    def _message_event(self, u, event):
+        # the raw dict, so nothing here triggers a stub refresh
+        message = dict.get(event, '_embedded', {}).get('message')
+        if message is None:
+            message = self._fetch(event['link']['href'])
+        if message.get('direction') != 'Incoming':
+            return
+        messaging = message['_links'].get('messaging')
+        if messaging is None:
+            return
+        conversation = self._conversations.get(messaging['href'])
+        if conversation is not None:
+            conversation._inbound_message(message)
+
+    @staticmethod
+    def _callback_key(rel, link_rel=None, ev_type=None):
         rel = [rel]
         if link_rel is not None:
             rel.append(link_rel)
             if ev_type is not None:
                 rel.append(ev_type)
-        rel = tuple(rel)
-        self.callbacks.setdefault(rel, []).append(callback)
-    
+        return tuple(rel)
+
+    def register_callback(self, callback, rel, link_rel=None, ev_type=None):
+        with self._callback_lock:
+            key = self._callback_key(rel, link_rel, ev_type)
+            self.callbacks.setdefault(key, []).append(callback)
+            self._compile_callbacks()
+
+    def unregister_callback(self, callback, rel, link_rel=None,
+                            ev_type=None):
+        with self._callback_lock:
+            key = self._callback_key(rel, link_rel, ev_type)
+            callbacks = self.callbacks.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self.callbacks[key]
+                self._compile_callbacks()
+
+    def _compile_callbacks(self):
+        """Rebuilds the dispatch trie from self.callbacks.
+
+        The trie is nested dicts rel -> link_rel -> ev_type, where every
+        node is a (callbacks, children) pair and `callbacks` already holds
+        the callbacks of all its ancestors, in the order rel, link_rel,
+        ev_type.  Dispatching an event is then just walking down as far as
+        the event goes and running the tuple found there."""
+        table = {}
+        # shorter keys first, so ancestors are in place before descendants
+        for key in sorted(self.callbacks, key=len):
+            callbacks, children = (), table
+            for part in key[:-1]:
+                if part not in children:
+                    children[part] = (callbacks, {})
+                callbacks, children = children[part]
+            children[key[-1]] = (callbacks + tuple(self.callbacks[key]), {})
+        # swapped in atomically; dispatch never sees a half-built trie
+        self._dispatch_table = table
+
+    def _dispatch(self, event, href=None):
+        """Runs the registered callbacks for one page of the events
+        channel, fetched from `href`, and moves on to the next."""
+        index = 0
+        for sender in event['sender']:
+            for ev in sender['events']:
+                self._handle_event(href, index, sender['rel'], ev)
+                index += 1
+        self._next_page(event['_links']['next']['href'])
+
+    def _handle_event(self, href, index, rel, ev):
+        """Dispatches the `index`th event of the page at `href` unless it
+        was handled before."""
+        key = (href, index)
+        with self._seen_lock:
+            if key in self._seen:
+                log.debug("dropping replayed event %d of %s" % (index, href))
+                return
+            self._seen[key] = True
+            if len(self._seen) > self.SEEN_EVENTS:
+                self._seen.popitem(last=False)
+        self._dispatch_event(rel, ev)
+
+    def _next_page(self, href):
+        """Moves the event channel on to the page at `href`.  Only whole
+        pages are saved, so a crash replays at most CURSOR_SAVE_INTERVAL
+        seconds of events; replays within a run are dropped by the
+        seen-set."""
+        self.event_href = href
+        self.save_cursor()
+
+    def save_cursor(self, force=False):
+        """Saves where the event channel is up to in the session store, at
+        most every CURSOR_SAVE_INTERVAL seconds unless `force`d; force it
+        when the channel stops being read."""
+        href = self.event_href
+        if self.session_store is None or href is None or \
+           href == self._cursor_saved:
+            return
+        if not force and \
+           time.time() - self._cursor_saved_at < self.CURSOR_SAVE_INTERVAL:
+            return
+        self._cursor_saved = href
+        self._cursor_saved_at = time.time()
+        self.session_store.update(self.username, events=href)
+
+    def _events_start(self):
+        return self.event_href or \
+            self.application['_links']['events']['href']
+
+    def _cursor_expired(self, error, href):
+        """Whether `error` means a stored cursor `href` has gone, so the
+        channel should start over from the application's."""
+        start = self.application['_links']['events']['href']
+        if href == start or not isinstance(error, HTTPError) or \
+           error.code not in (404, 410):
+            return False
+        log.info("event cursor of %s has gone, starting over" % self.username)
+        self.event_href = None
+        return True
+
+    def _dispatch_event(self, rel, ev):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Event: %s rel=%s" % (json.dumps(ev), rel))
+        # the resource changed, so our copy of it is out of date
+        self.cache.pop(ev['link']['href'])
+        self._apply_event(ev)
+        self._events_received.inc()
+        node = self._dispatch_table.get(rel)
+        if node is None:
+            return False
+        callbacks, links = node
+        link = links.get(ev['link']['rel'])
+        if link is not None:
+            callbacks, types = link
+            callbacks = types.get(ev['type'], (callbacks,))[0]
+        if not callbacks:
+            return False
+        self._events_dispatched.inc()
+        if self.tracer is not None:
+            with self.tracer.span('event', user=self.username, rel=rel,
+                                  link=ev['link']['rel'], type=ev['type']):
+                self._run_callbacks(callbacks, ev)
+        else:
+            self._run_callbacks(callbacks, ev)
+        return True
+
+    def _run_callbacks(self, callbacks, ev):
+        ev = UCWAResource(ev, ucwa=self)
+        for callback in callbacks:
+            start = time.time()
+            try:
+                callback(self, ev)
+            except Exception:
+                # one broken handler mustn't stop the event channel
+                log.exception("event callback %r failed" % callback)
+            finally:
+                self._callback_duration.observe(time.time() - start)
+
+    def _stream_events(self, href):
+        """Yields (page href, index, sender rel, event) from the event
+        channel, starting at `href`, as each event is decoded off the wire,
+        and (next page href, None, None, None) at the end of each page."""
+        failures = 0
+        while True:
+            try:
+                res = self._open(self._request(self.appbase + href))
+                stream = StreamDecoder(res)
+                # events of senders whose rel comes after their events
+                pending = []
+                # (sender, events) as read, to record the page by
+                recorder = self.recorder
+                senders = [] if recorder is not None else None
+                for index, ((root, sender), ev) in enumerate(stream.iter_path(
+                        ('sender', '*', 'events', '*'))):
+                    if senders is not None:
+                        if not senders or senders[-1][0] is not sender:
+                            senders.append((sender, []))
+                        senders[-1][1].append(ev)
+                    if pending and pending[-1][0] is not sender:
+                        for s, i, e in pending:
+                            yield href, i, s['rel'], e
+                        del pending[:]
+                    if 'rel' in sender:
+                        yield href, index, sender['rel'], ev
+                    else:
+                        pending.append((sender, index, ev))
+                for s, i, e in pending:
+                    yield href, i, s['rel'], e
+            except NETWORK_ERRORS + (ValueError,) as error:
+                if self._cursor_expired(error, href):
+                    href = self._events_start()
+                    continue
+                delay = self._channel_delay(error, failures)
+                if delay is None:
+                    raise
+                failures += 1
+                time.sleep(delay)
+                continue
+            failures = 0
+            if senders is not None:
+                recorder.page(self, href, dict(
+                    stream.root, sender=[dict(s, events=e)
+                                         for s, e in senders]))
+            href = stream.root['_links']['next']['href']
+            yield href, None, None, None
+
     def process_events(self):
-        """Handle incoming UCWA events by updating the local data model."""
+        """Handle incoming UCWA events by updating the local data model.
+        Picks up where the channel left off, even across restarts when
+        there is a session store, without handling any event twice."""
+        log.debug("Listening for events")
+        events = self._stream_events(self._events_start())
+        if self.prefetch_depth:
+            # keep reading the channel while callbacks run
+            events = Prefetcher(events, self.prefetch_depth)
+        for href, index, rel, ev in events:
+            if index is None:
+                self._next_page(href)
+            else:
+                self._handle_event(href, index, rel, ev)
+
+    async def aprocess_events(self):
+        """Async version of process_events.  The long-poll runs on the
+        event loop; callbacks, which may block, run in the loop's default
+        executor so other sessions keep polling."""
         log.debug("Listening for events")
-        for event in self.application.events():
-            for sender in event['sender']:
-                for ev in sender['events']:
-                    log.debug("Event: %s rel=%s" % (json.dumps(ev),
-                                                    sender['rel']))
-                    ev = UCWAResource(ev, ucwa=self)
-                    callbacks = self.callbacks.get(sender['rel'], [])
-                    callbacks += self.callbacks.get(
-                        (sender['rel'], ev['link']['rel']), [])
-                    callbacks += self.callbacks.get(
-                        (sender['rel'], ev['link']['rel'], ev['type']), [])
-                    for callback in callbacks:
-                        callback(self, ev)
+        loop = asyncio.get_event_loop()
+        href = self._events_start()
+        failures = 0
+        while True:
+            try:
+                res = await self._aopen(self._request(self.appbase + href))
+                event = json.loads(res.body.decode('utf-8'))
+            except NETWORK_ERRORS + (ValueError,) as error:
+                if self._cursor_expired(error, href):
+                    href = self._events_start()
+                    continue
+                delay = self._channel_delay(error, failures)
+                if delay is None:
+                    raise
+                failures += 1
+                await asyncio.sleep(delay)
+                continue
+            failures = 0
+            if self.recorder is not None:
+                self.recorder.page(self, href, event)
+            # the cursor is saved off the loop, in _dispatch
+            await loop.run_in_executor(None, self._dispatch, event, href)
+            href = event['_links']['next']['href']
         
     
 if __name__ == "__main__":
@@ -1,5 +1,12 @@
 from errbot import webhook
 
+from lyncbot import metrics
+
+try:
+    from bottle import response
+except ImportError:
+    response = None
+
 class WebInterface:
     @webhook('/lyncbot/login', raw=True)
     def login(self, request):
@@ -18,6 +25,12 @@ class WebInterface:
 to the login page and try again.</p>
 </body></html>"""
 
+    @webhook('/lyncbot/metrics', raw=True)
+    def metrics_page(self, request):
+        if response is not None:
+            response.content_type = metrics.CONTENT_TYPE
+        return self.render_metrics()
+
     @webhook('/lyncbot')
     def index(self, request):
         return """<html><body>
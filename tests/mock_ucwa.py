@@ -0,0 +1,600 @@
+"""
+mock_ucwa
+---------
+
+A small stand-in for a Lync/Skype for Business pool server, good enough to
+drive `lyncbot.ucwa.LyncUCWA` end to end without a real deployment.  It
+serves autodiscovery, the OAuth password grant, applications, people,
+presence, messaging and the long-poll event channel over plain HTTP.
+
+    server = MockUCWAServer(latency=0.005)
+    server.start()
+    server.add_user('alice@example.com', 'Alice Smith')
+    ...
+    server.stop()
+"""
+
+import re
+import json
+import hashlib
+import time
+import uuid
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs, unquote_plus
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote_plus
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+
+APP_ROOT = '/ucwa/oauth/v1/applications'
+USER_PATH = '/Autodiscover/AutodiscoverService.svc/root/oauth/user'
+
+
+class MockUser:
+    def __init__(self, email, name, password):
+        self.email = email
+        self.name = name
+        self.password = password
+        self.id = uuid.uuid4().hex[:8]
+        self.availability = 'Online'
+        self.contacts = []
+
+
+class MockApplication:
+    def __init__(self, user):
+        self.user = user
+        self.id = uuid.uuid4().hex[:12]
+        self.href = '%s/%s' % (APP_ROOT, self.id)
+        self.events = []
+        self.cond = threading.Condition()
+        self.conversations = {}
+        self.subscriptions = set()
+
+    def push(self, rel, href, events):
+        with self.cond:
+            self.events.append({'rel': rel, 'href': href, 'events': events})
+            self.cond.notify_all()
+
+
+class MockUCWAServer:
+    """Threaded in-process UCWA server.  `latency` seconds are added to
+    every request to simulate a remote pool."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 poll_timeout=5.0, token_lifetime=28800):
+        self.latency = latency
+        self.poll_timeout = poll_timeout
+        self.token_lifetime = token_lifetime
+        self.users = {}
+        self.tokens = {}
+        self.apps = {}
+        self.requests = []
+        self.faults = []
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.base = 'http://%s:%d' % self.httpd.server_address[:2]
+        self.thread = None
+
+    @property
+    def discover_url(self):
+        """Template for LyncUCWA.DISCOVER_URL pointing at this server."""
+        return self.base + '/discover/%s'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            apps = list(self.apps.values())
+        for app in apps:
+            with app.cond:
+                app.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fail(self, status=503, times=1, path='', headers=None):
+        """Answers the next `times` requests whose path contains `path`
+        with an error `status`."""
+        with self.lock:
+            self.faults.extend([(path, status, headers)] * times)
+
+    def truncate(self, times=1, path=''):
+        """Cuts the response to the next `times` requests whose path
+        contains `path` short, then drops the connection."""
+        self.fail(None, times, path)
+
+    def add_user(self, email, name=None, password='secret'):
+        user = MockUser(email, name or email.split('@')[0].title(), password)
+        self.users[email] = user
+        return user
+
+    def add_contact(self, email, contact_email):
+        self.users[email].contacts.append(self.users[contact_email])
+        self._contact_event(email, contact_email, 'added')
+
+    def remove_contact(self, email, contact_email):
+        self.users[email].contacts.remove(self.users[contact_email])
+        self._contact_event(email, contact_email, 'deleted')
+
+    def _contact_event(self, email, contact_email, ev_type):
+        app = self.app_for(email)
+        if app is not None:
+            app.push('people', app.href + '/people', [{
+                'link': {'rel': 'contact', 'href': '%s/people/%s' %
+                         (app.href, contact_email)},
+                'type': ev_type}])
+
+    def rename_user(self, email, name):
+        """Renames a user, telling everyone with them as a contact."""
+        user = self.users[email]
+        user.name = name
+        with self.lock:
+            apps = list(self.apps.values())
+        for app in apps:
+            if user in app.user.contacts:
+                app.push('people', app.href + '/people', [{
+                    'link': {'rel': 'contact', 'href': '%s/people/%s' %
+                             (app.href, email)},
+                    'type': 'updated',
+                    '_embedded': {'contact': self._contact(app, user)}}])
+
+    def app_for(self, email):
+        with self.lock:
+            for app in self.apps.values():
+                if app.user.email == email:
+                    return app
+
+    def set_availability(self, email, availability):
+        user = self.users[email]
+        user.availability = availability
+        with self.lock:
+            apps = list(self.apps.values())
+        for app in apps:
+            if user.email in app.subscriptions:
+                app.push('people', app.href + '/people', [{
+                    'link': {'rel': 'contactPresence',
+                             'href': '%s/people/%s/presence' %
+                             (app.href, user.email)},
+                    'type': 'updated'}])
+
+    def expire_tokens(self):
+        with self.lock:
+            self.tokens.clear()
+
+    def send_message(self, frm, to, text):
+        """Deliver an inbound message from user `frm` to user `to`,
+        starting a conversation if needed."""
+        app = self.app_for(to)
+        conv = None
+        for c in app.conversations.values():
+            if c['other'] == frm:
+                conv = c
+        if conv is None:
+            conv = self._new_conversation(app, frm)
+            invite = conv['href'] + '/invite'
+            app.push('communication', app.href + '/communication', [{
+                'link': {'rel': 'messagingInvitation', 'href': invite},
+                'type': 'started',
+                '_embedded': {'messagingInvitation':
+                              self._invitation(app, conv, 'Incoming')}}])
+        self._push_message(app, conv, 'Incoming', text)
+
+    def _new_conversation(self, app, other):
+        cid = uuid.uuid4().hex[:8]
+        conv = {'id': cid, 'other': other, 'messages': [],
+                'href': '%s/communication/conversations/%s' % (app.href, cid)}
+        app.conversations[cid] = conv
+        return conv
+
+    def _invitation(self, app, conv, direction):
+        other = self.users.get(conv['other'])
+        return {
+            '_links': {
+                'self': {'href': conv['href'] + '/invite'},
+                'from': {'href': '%s/people/%s' % (app.href, conv['other']),
+                         'title': other.name if other else conv['other']},
+                'conversation': {'href': conv['href']},
+                'messaging': {'href': conv['href'] + '/messaging'},
+                'accept': {'href': conv['href'] + '/invite/accept'},
+                'message': {'href': 'data:text/plain;charset=utf-8,' +
+                            (conv['messages'] or [''])[0].replace(' ', '+')},
+            },
+            'direction': direction,
+            'state': 'Connected',
+            'from': {'uri': 'sip:' + conv['other']},
+            'rel': 'messagingInvitation',
+        }
+
+    def _push_message(self, app, conv, direction, text):
+        mid = len(conv['messages'])
+        conv['messages'].append(text)
+        href = '%s/messages/%d' % (conv['href'], mid)
+        other = self.users.get(conv['other'])
+        message = {
+            '_links': {
+                'self': {'href': href},
+                'messaging': {'href': conv['href'] + '/messaging'},
+                'participant': {'href': '%s/participants/%s' %
+                                (conv['href'], conv['other']),
+                                'title': other.name if other else
+                                conv['other']},
+                'plainMessage': {'href': 'data:text/plain;charset=utf-8,' +
+                                 text.replace(' ', '+')},
+            },
+            'direction': direction,
+            'rel': 'message',
+        }
+        app.push('conversation', conv['href'], [{
+            'link': {'rel': 'message', 'href': href},
+            'type': 'completed',
+            '_embedded': {'message': message}}])
+
+    # -- resource builders -------------------------------------------------
+
+    def _contact(self, app, user):
+        href = '%s/people/%s' % (app.href, user.email)
+        return {
+            '_links': {
+                'self': {'href': href},
+                'contactPresence': {'href': href + '/presence'},
+            },
+            'name': user.name,
+            'uri': 'sip:' + user.email,
+            'emailAddresses': [user.email],
+            'rel': 'contact',
+        }
+
+    def _application(self, app):
+        h = app.href
+        me = app.user
+        return {
+            '_links': {
+                'self': {'href': h},
+                'events': {'href': h + '/events?ack=1'},
+                'batch': {'href': h + '/batch'},
+            },
+            '_embedded': {
+                'me': {
+                    '_links': {
+                        'self': {'href': h + '/me'},
+                        'makeMeAvailable': {'href': h + '/me/makeMeAvailable'},
+                    },
+                    'name': me.name,
+                    'uri': 'sip:' + me.email,
+                    'rel': 'me',
+                },
+                'people': {
+                    '_links': {
+                        'self': {'href': h + '/people'},
+                        'search': {'href': h + '/people/search'},
+                        'myContacts': {'href': h + '/people/contacts'},
+                        'presenceSubscriptions': {
+                            'href': h + '/people/presenceSubscriptions'},
+                    },
+                    'rel': 'people',
+                },
+                'communication': {
+                    '_links': {
+                        'self': {'href': h + '/communication'},
+                        'startMessaging': {
+                            'href': h + '/communication/messagingInvitations'},
+                        'conversations': {
+                            'href': h + '/communication/conversations'},
+                    },
+                    'supportedMessageFormats': ['Plain', 'Html'],
+                    'rel': 'communication',
+                },
+            },
+            'rel': 'application',
+        }
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, body=None, headers=None):
+            data = b''
+            headers = dict(headers or {})
+            if body is not None:
+                data = json.dumps(body, sort_keys=True).encode('utf-8')
+                headers.setdefault('Content-Type', 'application/json')
+                if self.command == 'GET' and status == 200:
+                    etag = '"%s"' % hashlib.md5(data).hexdigest()
+                    headers['ETag'] = etag
+                    if self.headers.get('If-None-Match') == etag:
+                        status, data = 304, b''
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _truncated(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            self.wfile.write(b'{"_links": ')
+            self.close_connection = True
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _app(self):
+            auth = self.headers.get('Authorization', '')
+            with server.lock:
+                email = server.tokens.get(auth.split(' ')[-1])
+            if email is None:
+                return None
+            return server.app_for(email) or email
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def _handle(self, method):
+            if server.latency:
+                time.sleep(server.latency)
+            url = urlparse(self.path)
+            with server.lock:
+                server.requests.append((method, url.path))
+                fault = next((f for f in server.faults if f[0] in url.path),
+                             None)
+                if fault is not None:
+                    server.faults.remove(fault)
+            body = self._body()
+            try:
+                if fault is not None and fault[1] is None:
+                    return self._truncated()
+                if fault is not None:
+                    return self._reply(fault[1], {'code': 'ServiceFailure'},
+                                       fault[2])
+                self._route(method, url.path, parse_qs(url.query), body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def _route(self, method, path, query, body):
+            if path.startswith('/discover/'):
+                return self._reply(200, {'_links': {
+                    'user': {'href': server.base + USER_PATH}}})
+            if path == '/WebTicket/oauthtoken':
+                form = parse_qs(body.decode('utf-8'))
+                user = server.users.get(form.get('username', [''])[0])
+                if user is None or form.get('password', [''])[0] != \
+                        user.password:
+                    return self._reply(400, {'error': 'invalid_grant'})
+                token = uuid.uuid4().hex
+                with server.lock:
+                    server.tokens[token] = user.email
+                return self._reply(200, {
+                    'access_token': token, 'token_type': 'Bearer',
+                    'expires_in': server.token_lifetime})
+
+            app = self._app()
+            if app is None:
+                return self._reply(401, headers={
+                    'WWW-Authenticate': 'Bearer trusted_issuers="", '
+                    'client_id="00000004-0000-0ff1-ce00-000000000000", '
+                    'MsRtcOAuth href="%s/WebTicket/oauthtoken",'
+                    'grant_type="urn:microsoft.rtc:windows,'
+                    'urn:microsoft.rtc:anonmeeting,password"' % server.base})
+
+            if path == USER_PATH:
+                return self._reply(200, {'_links': {
+                    'self': {'href': server.base + USER_PATH},
+                    'applications': {'href': server.base + APP_ROOT}}})
+            if path == APP_ROOT and method == 'POST':
+                email = app if isinstance(app, str) else app.user.email
+                new = MockApplication(server.users[email])
+                with server.lock:
+                    for old in [k for k, v in server.apps.items()
+                                if v.user.email == email]:
+                        del server.apps[old]
+                    server.apps[new.id] = new
+                return self._reply(201, server._application(new))
+            if isinstance(app, str) or not path.startswith(app.href):
+                return self._reply(404, {'code': 'NotFound'})
+            return self._app_route(app, method, path[len(app.href):],
+                                   query, body)
+
+        def _app_route(self, app, method, rest, query, body):
+            h = app.href
+            if rest == '':
+                if method == 'DELETE':
+                    return self._reply(204)
+                return self._reply(200, server._application(app))
+            if rest == '/events':
+                return self._events(app, int(query.get('ack', ['1'])[0]),
+                                    float(query.get('timeout', [
+                                        server.poll_timeout])[0]))
+            if rest == '/batch':
+                return self._batch(app, body)
+            if rest == '/me':
+                return self._reply(200, server._application(app)
+                                   ['_embedded']['me'])
+            if rest == '/me/makeMeAvailable':
+                return self._reply(204)
+            if rest == '/people':
+                return self._reply(200, server._application(app)
+                                   ['_embedded']['people'])
+            if rest == '/people/contacts':
+                return self._reply(200, {
+                    '_links': {'self': {'href': h + rest}},
+                    '_embedded': {'contact': [
+                        server._contact(app, c) for c in app.user.contacts]},
+                    'rel': 'myContacts'})
+            if rest == '/people/search':
+                q = urlparse(self.path).query
+                q = parse_qs(q).get('query', [''])[0].lower()
+                hits = [u for u in server.users.values()
+                        if u.name.lower().startswith(q) or u.email == q]
+                return self._reply(200, {
+                    '_links': {'self': {'href': h + rest}},
+                    '_embedded': {'contact': [
+                        server._contact(app, u) for u in hits]},
+                    'rel': 'search'})
+            if rest == '/people/presenceSubscriptions' and method == 'POST':
+                data = json.loads(body.decode('utf-8'))
+                for uri in data.get('uris', []):
+                    app.subscriptions.add(uri.split(':', 1)[-1])
+                sid = uuid.uuid4().hex[:6]
+                href = '%s%s/%s' % (h, rest, sid)
+                return self._reply(201, {
+                    '_links': {
+                        'self': {'href': href},
+                        'extend': {'href': href + '/extend'}},
+                    'duration': data.get('duration', 30),
+                    'rel': 'presenceSubscription'},
+                    headers={'Location': href})
+            if rest.startswith('/people/presenceSubscriptions/') and \
+                    rest.endswith('/extend'):
+                return self._reply(204)
+            m = re.match(r'^/people/([^/]+)(/presence)?$', rest)
+            if m:
+                user = server.users.get(m.group(1))
+                if user is None:
+                    return self._reply(404, {'code': 'NotFound'})
+                if m.group(2):
+                    return self._reply(200, {
+                        '_links': {'self': {'href': h + rest}},
+                        'availability': user.availability,
+                        'rel': 'contactPresence'})
+                return self._reply(200, server._contact(app, user))
+            if rest == '/communication':
+                return self._reply(200, server._application(app)
+                                   ['_embedded']['communication'])
+            if rest == '/communication/messagingInvitations':
+                data = json.loads(body.decode('utf-8'))
+                other = data['to'].split(':', 1)[-1]
+                conv = server._new_conversation(app, other)
+                first = data.get('_links', {}).get('message', {}).get('href')
+                if first:
+                    conv['messages'].append(
+                        unquote_plus(first.split(',', 1)[1]))
+                loc = conv['href'] + '/invite'
+                self._reply(201, headers={'Location': loc})
+                app.push('communication', h + '/communication', [{
+                    'link': {'rel': 'messagingInvitation', 'href': loc},
+                    'type': 'completed', 'status': 'Success'}])
+                return
+            m = re.match(r'^/communication/conversations/([^/]+)(/.*)?$',
+                         rest)
+            if m:
+                conv = app.conversations.get(m.group(1))
+                if conv is None:
+                    return self._reply(404, {'code': 'NotFound'})
+                sub = m.group(2) or ''
+                if sub == '':
+                    return self._reply(200, {
+                        '_links': {
+                            'self': {'href': conv['href']},
+                            'messaging': {'href': conv['href'] +
+                                          '/messaging'}},
+                        'state': 'Connected', 'rel': 'conversation'})
+                if sub.startswith('/participants/'):
+                    other = server.users.get(sub.split('/')[-1])
+                    name = other.name if other else conv['other']
+                    return self._reply(200, {
+                        '_links': {'self': {'href': conv['href'] + sub}},
+                        'name': name, 'title': name,
+                        'uri': 'sip:' + conv['other'],
+                        'rel': 'participant'})
+                if sub == '/invite':
+                    return self._reply(200, server._invitation(
+                        app, conv, 'Outgoing'))
+                if sub == '/invite/accept':
+                    return self._reply(204)
+                if sub == '/messaging':
+                    return self._reply(200, {
+                        '_links': {
+                            'self': {'href': conv['href'] + '/messaging'},
+                            'sendMessage': {'href': conv['href'] +
+                                            '/messaging/messages'},
+                            'stopMessaging': {'href': conv['href'] +
+                                              '/messaging/terminate'}},
+                        'state': 'Connected', 'rel': 'messaging'})
+                if sub == '/messaging/messages' and method == 'POST':
+                    conv['messages'].append(body.decode('utf-8'))
+                    return self._reply(201, headers={
+                        'Location': '%s/messages/%d' %
+                        (conv['href'], len(conv['messages']) - 1)})
+                if sub == '/messaging/terminate':
+                    return self._reply(204)
+            return self._reply(404, {'code': 'NotFound'})
+
+        def _events(self, app, ack, timeout):
+            deadline = time.time() + timeout
+            with app.cond:
+                while len(app.events) < ack and time.time() < deadline and \
+                        server.apps.get(app.id) is app:
+                    app.cond.wait(max(0.0, deadline - time.time()))
+                senders = app.events[ack - 1:]
+            nxt = ack + len(senders)
+            self._reply(200, {
+                '_links': {
+                    'self': {'href': '%s/events?ack=%d' % (app.href, ack)},
+                    'next': {'href': '%s/events?ack=%d' % (app.href, nxt)}},
+                'sender': senders})
+
+        def _batch(self, app, body):
+            ctype = self.headers.get('Content-Type', '')
+            boundary = ctype.split('boundary=', 1)[-1].strip('"')
+            parts = body.decode('utf-8').split('--' + boundary)
+            out_boundary = uuid.uuid4().hex
+            out = []
+            for part in parts:
+                m = re.search(r'^GET (\S+) HTTP/1.1', part, re.M)
+                if not m:
+                    continue
+                rest = m.group(1)[len(app.href):]
+                mp = re.match(r'^/people/([^/]+)(/presence)?$', rest)
+                user = server.users.get(mp.group(1)) if mp else None
+                if user is None:
+                    out.append('HTTP/1.1 404 Not Found\r\n\r\n')
+                    continue
+                if mp.group(2):
+                    res = {'_links': {'self': {'href': m.group(1)}},
+                           'availability': user.availability,
+                           'rel': 'contactPresence'}
+                else:
+                    res = server._contact(app, user)
+                data = json.dumps(res)
+                out.append('HTTP/1.1 200 OK\r\nContent-Type: application/'
+                           'json; charset=utf-8\r\nContent-Length: %d\r\n'
+                           '\r\n%s' % (len(data), data))
+            payload = ''.join(
+                '--%s\r\nContent-Type: application/http; msgtype=response'
+                '\r\n\r\n%s\r\n' % (out_boundary, p) for p in out)
+            payload += '--%s--\r\n' % out_boundary
+            data = payload.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/batching; '
+                             'boundary=%s' % out_boundary)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
@@ -5,39 +5,537 @@
 test_lyncbot
 ----------------------------------
 
-Tests for `lyncbot` module.
+Tests for `lyncbot` module, run against the mock UCWA server.
 """
 
 
+import io
+import os
 import sys
+import json
+import base64
+import time
+import queue
+import shutil
+import tempfile
+import threading
 import unittest
-from contextlib import contextmanager
-from click.testing import CliRunner
+from urllib.error import HTTPError
+from urllib.parse import quote
 
-from lyncbot import lyncbot
-from lyncbot import cli
+from lyncbot import ucwa, transport, recorder, aio
+from lyncbot.cache import TTLCache
+from lyncbot.contacts import ContactIndex
+from lyncbot.jsonstream import iter_path
+from lyncbot.session import SessionStore
+from lyncbot.sharding import HashRing
+from tests.mock_ucwa import MockUCWAServer
 
 
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting")
+        time.sleep(0.01)
 
-class TestLyncbot(unittest.TestCase):
 
-    def setUp(self):
-        pass
+class TestLyncUCWA(unittest.TestCase):
 
-    def tearDown(self):
-        pass
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockUCWAServer(poll_timeout=1).start()
+        cls.discover_url = ucwa.LyncUCWA.DISCOVER_URL
+        ucwa.LyncUCWA.DISCOVER_URL = cls.server.discover_url
+        cls.server.add_user('alice@example.com', 'Alice Smith')
+        cls.server.add_user('bob@example.com', 'Bob Jones')
+        cls.server.add_contact('alice@example.com', 'bob@example.com')
+        cls.u = ucwa.LyncUCWA('alice@example.com', 'secret',
+                              retry_policy=transport.RetryPolicy(base=0.01))
+        # invitations complete and messages arrive on the event channel
+        thread = threading.Thread(target=cls.u.process_events)
+        thread.daemon = True
+        thread.start()
 
-    def test_000_something(self):
-        pass
+    @classmethod
+    def tearDownClass(cls):
+        ucwa.LyncUCWA.DISCOVER_URL = cls.discover_url
+        # discovered URLs point at this server
+        ucwa.discovery_cache.clear()
+        cls.server.stop()
+        cls.u.transport.clear()
 
-    def test_command_line_interface(self):
-        runner = CliRunner()
-        result = runner.invoke(cli.main)
-        assert result.exit_code == 0
-        assert 'lyncbot.cli.main' in result.output
-        help_result = runner.invoke(cli.main, ['--help'])
-        assert help_result.exit_code == 0
-        assert '--help  Show this message and exit.' in help_result.output
+    def test_000_login(self):
+        self.assertIn('_links', self.u.application)
+        self.assertTrue(self.u.auth_headers['Authorization'])
+
+    def test_bad_password(self):
+        with self.assertRaises(Exception):
+            ucwa.LyncUCWA('alice@example.com', 'wrong')
+
+    def test_contacts(self):
+        names = [c.name for c in self.u.contacts('bob')]
+        self.assertEqual(names, ['Bob Jones'])
+        self.assertEqual(self.u.contacts('nobody'), [])
+
+    def test_contact_renamed(self):
+        self.u.contacts()
+        self.server.rename_user('bob@example.com', 'Zed Jones')
+        try:
+            wait_for(lambda: self.u.contacts('zed'))
+            self.assertEqual(self.u.contacts('bob'), [])
+        finally:
+            self.server.rename_user('bob@example.com', 'Bob Jones')
+            wait_for(lambda: self.u.contacts('bob'))
+        self.assertEqual(self.u.contacts('zed'), [])
+
+    def test_parse_batch(self):
+        payload = (
+            'preamble\r\n--b1\r\nContent-Type: application/http; '
+            'msgtype=response\r\n\r\nHTTP/1.1 200 OK\r\nContent-Type: '
+            'application/json\r\n\r\n{"name": "x"}\r\n'
+            '--b1\r\nContent-Type: application/http; msgtype=response\r\n'
+            '\r\nHTTP/1.1 404 Not Found\r\n\r\n\r\n'
+            '--b1\r\nContent-Type: application/http; msgtype=response\r\n'
+            '\r\nHTTP/1.1 204 No Content\r\n\r\n\r\n'
+            '--b1--\r\nepilogue')
+        self.assertEqual(ucwa.LyncUCWA._parse_batch(payload, 'b1'),
+                         [{'name': 'x'}, None, None])
+
+    def test_hydrate(self):
+        app = self.u.application['_links']['self']['href']
+        base = app + '/people/'
+        bob, nobody = [ucwa.UCWAResource(href=base + email, ucwa=self.u)
+                       for email in ('bob@example.com', 'nobody@example.com')]
+        self.u.cache.clear()
+        before = len(self.server.requests)
+        self.u.hydrate([bob, nobody])
+        self.assertEqual([r for r in self.server.requests[before:]
+                          if '/people/' in r[1] or r[1].endswith('/batch')],
+                         [('POST', app + '/batch')])
+        self.assertFalse(bob._stub)
+        self.assertEqual(bob['name'], 'Bob Jones')
+        self.assertTrue(nobody._stub)
+        # fetched ones are cached, so hydrating again costs nothing
+        again = ucwa.UCWAResource(href=base + 'bob@example.com', ucwa=self.u)
+        before = len(self.server.requests)
+        self.u.hydrate([again])
+        self.assertFalse(again._stub)
+        self.assertFalse([r for r in self.server.requests[before:]
+                          if r[1].endswith('/batch')])
+
+    def test_presence(self):
+        bob = self.u.contacts('bob')[0]
+        self.assertEqual(self.u.availability(bob), 'Online')
+        presence = bob['_links']['contactPresence']['href']
+        self.assertIn(presence, self.u._presence)
+        before = len(self.server.requests)
+        self.assertEqual(self.u.availability(bob), 'Online')
+        self.assertNotIn(('GET', presence), self.server.requests[before:])
+        self.server.set_availability('bob@example.com', 'Away')
+        try:
+            wait_for(lambda: self.u.availability(bob) == 'Away')
+        finally:
+            self.server.set_availability('bob@example.com', 'Online')
+        wait_for(lambda: self.u.availability(bob) == 'Online')
+
+    def test_send_message(self):
+        chat = self.u.new_conversation(['bob@example.com'])
+        chat.send('hello there')
+        chat.send('again')
+        conv = list(self.server.app_for(
+            'alice@example.com').conversations.values())[-1]
+        self.assertEqual(conv['messages'], ['hello there', 'again'])
+
+    def test_send_non_ascii(self):
+        chat = self.u.new_conversation(['bob@example.com'])
+        for text in ('first', u'h\xe9llo w\xf6rld \u2713', 'after'):
+            chat.send(text)
+        conv = list(self.server.app_for(
+            'alice@example.com').conversations.values())[-1]
+        self.assertEqual(conv['messages'],
+                         ['first', u'h\xe9llo w\xf6rld \u2713', 'after'])
+
+    def test_invitation_forgotten(self):
+        key = ('communication', 'messagingInvitation', 'completed')
+        callbacks = list(self.u.callbacks[key])
+        for i in range(3):
+            chat = self.u.new_conversation(['bob@example.com'])
+            chat.send('hello')
+            chat.close()
+        self.assertEqual(self.u._invitations, {})
+        self.assertEqual(self.u.callbacks[key], callbacks)
+
+    def test_inbound_message(self):
+        received = []
+        chat = self.u.new_conversation(['bob@example.com'])
+        chat.set_inbound_callback(received.append)
+        chat.send('ping')
+        self.server.send_message('bob@example.com', 'alice@example.com',
+                                 'pong')
+        wait_for(lambda: received)
+        self.assertEqual(received, ['Bob: pong'])
+
+    def test_token_expiry(self):
+        def grants():
+            return [r for r in self.server.requests
+                    if r == ('POST', '/WebTicket/oauthtoken')]
+        before = len(grants())
+        self.server.expire_tokens()
+        self.u.cache.clear()
+        self.u.application.refresh()
+        self.assertIn('_links', self.u.application)
+        self.assertEqual(len(grants()), before + 1)
+
+    def session_store(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        return SessionStore(os.path.join(tmp, 'sessions'),
+                            SessionStore.generate_key())
+
+    def logins(self):
+        return self.server.requests.count(('POST', '/WebTicket/oauthtoken'))
+
+    def test_resume(self):
+        self.server.add_user('gina@example.com', 'Gina Brown')
+        store = self.session_store()
+        first = ucwa.LyncUCWA('gina@example.com', 'secret',
+                              session_store=store)
+        self.addCleanup(first.transport.clear)
+        logins = self.logins()
+        # no password needed while the stored session lives
+        u = ucwa.LyncUCWA('gina@example.com', session_store=store)
+        self.addCleanup(u.transport.clear)
+        self.assertEqual(self.logins(), logins)
+        self.assertEqual(u.application['_links']['self']['href'],
+                         first.application['_links']['self']['href'])
+        self.assertEqual(u.application.me.name, 'Gina Brown')
+
+    def test_resume_fallback(self):
+        self.server.add_user('hank@example.com', 'Hank Gray')
+        store = self.session_store()
+        first = ucwa.LyncUCWA('hank@example.com', 'secret',
+                              session_store=store)
+        self.addCleanup(first.transport.clear)
+        gone = first.application['_links']['self']['href'] + 'gone'
+        store.update('hank@example.com', application=gone)
+        with self.assertRaises(Exception):
+            ucwa.LyncUCWA('hank@example.com', session_store=store)
+        # a stale session falls back to a full login, and is replaced
+        logins = self.logins()
+        u = ucwa.LyncUCWA('hank@example.com', 'secret', session_store=store)
+        self.addCleanup(u.transport.clear)
+        self.assertEqual(self.logins(), logins + 1)
+        self.assertNotEqual(store.get('hank@example.com')['application'],
+                            gone)
+        store.update('hank@example.com', expires=0)
+        u = ucwa.LyncUCWA('hank@example.com', 'secret', session_store=store)
+        self.addCleanup(u.transport.clear)
+        self.assertEqual(self.logins(), logins + 2)
+
+    def test_retry(self):
+        self.server.fail(503, times=2, path='/application')
+        self.u.cache.clear()
+        self.u.application.refresh()
+        self.assertIn('_links', self.u.application)
+
+    def test_channel_survives_failures(self):
+        def broken(u, ev):
+            raise RuntimeError("broken handler")
+        received = []
+        chat = self.u.new_conversation(['bob@example.com'])
+        chat.set_inbound_callback(received.append)
+        chat.send('ping')
+        self.u.register_callback(broken, 'conversation')
+        try:
+            self.server.truncate(times=2, path='/events')
+            self.server.send_message('bob@example.com', 'alice@example.com',
+                                     'still here')
+            wait_for(lambda: received)
+        finally:
+            self.u.unregister_callback(broken, 'conversation')
+        self.assertEqual(received, ['Bob: still here'])
+
+    def test_replayed_events(self):
+        seen = []
+
+        def callback(u, ev):
+            seen.append(ev['type'])
+        events = [{'link': {'rel': 'thing', 'href': '/thing'}, 'type': t}
+                  for t in ('added', 'deleted')]
+        page = {'_links': {'next': {'href': '/events?ack=101'}},
+                'sender': [{'rel': 'test', 'events': events}]}
+        self.u.register_callback(callback, 'test')
+        try:
+            self.u._dispatch(page, '/events?ack=99')
+            self.u._dispatch(page, '/events?ack=99')
+        finally:
+            self.u.unregister_callback(callback, 'test')
+        self.assertEqual(seen, ['added', 'deleted'])
+        self.assertEqual(self.u.event_href, '/events?ack=101')
+
+    def test_record_replay(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        received, live, replayed = [], [], []
+
+        def track(seen):
+            return lambda u: u.register_callback(
+                lambda u, ev: seen.append(ev['type']), 'conversation',
+                link_rel='message')
+        rec = self.u.recorder = recorder.Recorder(path)
+        try:
+            rec.session(self.u)
+            callbacks = dict((k, list(v)) for k, v in self.u.callbacks.items())
+            track(live)(self.u)
+            chat = self.u.new_conversation(['bob@example.com'])
+            chat.set_inbound_callback(received.append)
+            chat.send('ping')
+            self.server.send_message('bob@example.com', 'alice@example.com',
+                                     'recorded')
+            wait_for(lambda: received)
+            # the page is recorded once it has been read to the end
+            records = rec.records
+            wait_for(lambda: rec.records > records)
+        finally:
+            self.u.callbacks = callbacks
+            self.u._compile_callbacks()
+            self.u.recorder = None
+            rec.close()
+        replayer = recorder.Replayer(path, track(replayed))
+        replayer.run()
+        self.assertTrue(replayed)
+        self.assertEqual(replayed, live[:len(replayed)])
+        self.assertEqual(replayer.transport.misses, 0)
+
+
+class TestEventMultiplexer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockUCWAServer(poll_timeout=1).start()
+        cls.discover_url = ucwa.LyncUCWA.DISCOVER_URL
+        ucwa.LyncUCWA.DISCOVER_URL = cls.server.discover_url
+        cls.server.add_user('carol@example.com', 'Carol White')
+        cls.server.add_user('dave@example.com', 'Dave Black')
+        cls.server.add_user('erin@example.com', 'Erin Green')
+        cls.server.add_contact('carol@example.com', 'dave@example.com')
+        cls.mux = aio.EventMultiplexer().start()
+        cls.u = ucwa.LyncUCWA('carol@example.com', 'secret',
+                              async_transport=cls.mux.http)
+        cls.mux.add(cls.u)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mux.stop()
+        ucwa.LyncUCWA.DISCOVER_URL = cls.discover_url
+        # discovered URLs point at this server
+        ucwa.discovery_cache.clear()
+        cls.server.stop()
+        cls.u.transport.clear()
+
+    def test_listener(self):
+        wait_for(lambda: self.mux.listening(self.u))
+        invited = []
+        self.u.set_invitation_callback(invited.append)
+        self.server.send_message('erin@example.com', 'carol@example.com',
+                                 'hi carol')
+        wait_for(lambda: invited)
+        self.assertEqual(invited[0].other, ['erin@example.com'])
+        self.assertTrue(self.mux.listening(self.u))
+
+    def queue(self, chat, texts, results, timeout=None):
+        for text in texts:
+            chat.queue_message(
+                text, lambda t, e: results.append((t, e)), timeout)
+
+    def sent(self, first):
+        app = self.server.app_for('carol@example.com')
+        return [c['messages'] for c in list(app.conversations.values())
+                if c['messages'][:1] == [first]][0]
+
+    def test_outbox_order(self):
+        texts = ['order %d' % i for i in range(10)]
+        results = []
+        self.queue(self.u.new_conversation(['dave@example.com']), texts,
+                   results)
+        wait_for(lambda: len(results) == len(texts))
+        self.assertEqual(results, [(t, None) for t in texts])
+        self.assertEqual(self.sent(texts[0]), texts)
+
+    def test_outbox_full(self):
+        chat = self.u.new_conversation(['dave@example.com'])
+        chat._outbox = queue.Queue(2)
+        results = []
+        self.server.latency = 0.2
+        try:
+            with self.assertRaises(ucwa.OutboxFull):
+                self.queue(chat, ['full %d' % i for i in range(5)], results,
+                           timeout=0)
+        finally:
+            self.server.latency = 0
+        wait_for(lambda: results and chat.outbox_depth() == 0)
+        self.assertTrue(all(e is None for t, e in results))
+
+    def test_delivery_error(self):
+        chat = self.u.new_conversation(['dave@example.com'])
+        results = []
+        self.queue(chat, ['before'], results)
+        wait_for(lambda: results)
+        self.server.fail(500, path='/messaging/messages')
+        self.queue(chat, ['lost', 'after'], results)
+        wait_for(lambda: len(results) == 3)
+        self.assertEqual([t for t, e in results], ['before', 'lost', 'after'])
+        self.assertIsNone(results[0][1])
+        self.assertIsNotNone(results[1][1])
+        self.assertIsNone(results[2][1])
+        self.assertEqual(self.sent('before'), ['before', 'after'])
+
+    def test_failing_delivery_callback(self):
+        chat = self.u.new_conversation(['dave@example.com'])
+        sent = []
+
+        def delivered(text, error):
+            sent.append(text)
+            raise RuntimeError("callback failed")
+        chat.queue_message('one', delivered)
+        wait_for(lambda: sent)
+        chat.queue_message('two', delivered)
+        wait_for(lambda: len(sent) == 2)
+        self.assertEqual(self.sent('one'), ['one', 'two'])
+
+    def test_cursor_saved_on_remove(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = SessionStore(os.path.join(tmp, 'sessions'),
+                             SessionStore.generate_key())
+        u = ucwa.LyncUCWA('dave@example.com', 'secret',
+                          async_transport=self.mux.http, session_store=store)
+        u.CURSOR_SAVE_INTERVAL = 3600
+
+        def saved():
+            return store.get('dave@example.com').get('events')
+        self.mux.add(u)
+        wait_for(lambda: saved())
+        self.server.send_message('erin@example.com', 'dave@example.com',
+                                 'hi dave')
+        wait_for(lambda: u.event_href != saved())
+        self.mux.remove(u)
+        wait_for(lambda: not self.mux.listening(u))
+        wait_for(lambda: saved() == u.event_href)
+        u.transport.clear()
+
+
+class TestDataHref(unittest.TestCase):
+
+    def test_base64_charset(self):
+        href = 'data:text/plain;charset=iso-8859-1;base64,' + \
+            base64.b64encode(u'h\xe9llo'.encode('iso-8859-1')).decode()
+        d = ucwa.DataHref(href)
+        self.assertEqual(d, u'h\xe9llo')
+        self.assertEqual(d.encoding, 'base64')
+        self.assertEqual(d.href(), href)
+
+    def test_defaults(self):
+        d = ucwa.DataHref('data:,hello%20there+again')
+        self.assertEqual(d, 'hello there again')
+        self.assertEqual(d.content_type, 'text/plain')
+        self.assertEqual(d.encoding, 'charset=utf-8')
+        d = ucwa.DataHref('data:text/plain;charset=utf-8,caf%C3%A9')
+        self.assertEqual(d, u'caf\xe9')
+
+    def test_round_trip(self):
+        text = u'h\xe9llo & w\xf6rld \u2713'
+        self.assertEqual(ucwa.DataHref(ucwa.DataHref.from_str(text).href()),
+                         text)
+
+    def test_plaintext(self):
+        d = ucwa.DataHref('data:text/html;charset=utf-8,' + quote(
+            '<p>Tom &amp; <b>Jerry</b></p>\n<p>&lt;3</p>'))
+        self.assertEqual(d.plaintext(), 'Tom & Jerry <3')
+        d = ucwa.DataHref('data:text/html,<div>just  text</div>')
+        self.assertEqual(d.plaintext(), 'just text')
+        # only HTML has entities to decode
+        d = ucwa.DataHref.from_str('Tom &amp; Jerry')
+        self.assertEqual(d.plaintext(), 'Tom &amp; Jerry')
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def error(self, code, retry_after):
+        return HTTPError('/x', code, 'busy', {'Retry-After': retry_after},
+                         None)
+
+    def test_retry_after_capped(self):
+        policy = transport.RetryPolicy(cap=30)
+        self.assertEqual(policy.delay(self.error(503, '10'), 0), 10)
+        self.assertIsNone(policy.delay(self.error(503, '86400'), 0))
+        self.assertEqual(
+            policy.delay(self.error(503, '86400'), 0, forever=True), 30)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_lru(self):
+        c = TTLCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (1, None, 3))
+
+    def test_expiry(self):
+        c = TTLCache(ttl=0)
+        c.set('a', 1)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.lookup('a'), (1, False))
+
+
+class TestContactIndex(unittest.TestCase):
+
+    def contact(self, name, email):
+        return {'_links': {'self': {'href': '/people/' + email}},
+                'name': name, 'emailAddresses': [email]}
+
+    def test_prefix(self):
+        index = ContactIndex([self.contact('Bob Jones', 'bob@x'),
+                              self.contact('Bobby Tables', 'bobby@x'),
+                              self.contact('Alice Smith', 'alice@x')])
+        self.assertEqual([c['name'] for c in index.prefix('bob')],
+                         ['Bob Jones', 'Bobby Tables'])
+        index.remove('/people/bob@x')
+        self.assertEqual([c['name'] for c in index.prefix('BOB')],
+                         ['Bobby Tables'])
+        self.assertEqual(index.email('alice@x')[0]['name'], 'Alice Smith')
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def test_iter_path(self):
+        doc = {'_links': {'next': {'href': '/n'}},
+               'sender': [{'rel': 'a', 'events': [1, 2]},
+                          {'events': [3], 'rel': 'b'}]}
+        fp = io.BytesIO(json.dumps(doc).encode('utf-8'))
+        items = list(iter_path(fp, ('sender', '*', 'events', '*'),
+                               chunk_size=3))
+        self.assertEqual([v for _, v in items], [1, 2, 3])
+        self.assertEqual(items[0][0][1]['rel'], 'a')
+        self.assertEqual(items[0][0][0]['_links']['next']['href'], '/n')
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_rebalance(self):
+        keys = ['user%d@example.com' % i for i in range(1000)]
+        ring = HashRing(range(4))
+        before = dict((k, ring.node_for(k)) for k in keys)
+        self.assertEqual(set(before.values()), set(range(4)))
+        ring.add(4)
+        moved = [k for k in keys if ring.node_for(k) != before[k]]
+        # only keys taken over by the new node move
+        self.assertTrue(all(ring.node_for(k) == 4 for k in moved))
+        self.assertLess(len(moved), 400)
 
 
 if __name__ == '__main__':